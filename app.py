@@ -1,12 +1,46 @@
-from reactpy import component, html, hooks, run
-from reactpy_router import route, simple
-from dataclasses import dataclass
-from typing import List, Dict
-import random
+from reactpy import component, html, hooks
+from reactpy.backend.types import Connection, Location
+from reactpy.core.hooks import ConnectionContext
+from reactpy.core.layout import Layout
+from reactpy.utils import vdom_to_html
+from dataclasses import dataclass, field, replace
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Callable, List, Dict, Iterable, Iterator, Optional, Sequence, Set, Tuple
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+from http.cookies import SimpleCookie
+from itertools import chain, islice, repeat
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlparse
+from urllib.request import urlopen
+from uuid import uuid4
+import argparse
+import asyncio
+import csv
+import hashlib
+import heapq
+import io
+import inspect
+import json
+import math
+import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import weakref
+
+import numpy as np
 
 # ========== MODELS ==========
 
-@dataclass
+@dataclass(slots=True)
 class Product:
     id: int
     name: str
@@ -16,41 +50,166 @@ class Product:
     category: str
     stock: int
     rating: float = 0.0
+    # Bumped whenever a displayed field changes, so cached views can be reused
+    version: int = 0
+
+def _column_property(column: str) -> property:
+    def get(self):
+        return getattr(self._store, column)[self._index]
+    
+    def set(self, value):
+        getattr(self._store, column)[self._index] = value
+    
+    return property(get, set)
+
+class ProductRow:
+    # Lightweight view over one row of a ColumnarProductStore. Reads and
+    # writes go straight to the store's columns, so it can be used anywhere
+    # a Product is expected.
+    __slots__ = ("_store", "_index")
+    
+    def __init__(self, store: "ColumnarProductStore", index: int):
+        self._store = store
+        self._index = index
+    
+    id = _column_property("ids")
+    name = _column_property("names")
+    description = _column_property("descriptions")
+    price = _column_property("prices")
+    image_url = _column_property("image_urls")
+    stock = _column_property("stocks")
+    rating = _column_property("ratings")
+    version = _column_property("versions")
+    
+    @property
+    def category(self) -> str:
+        return self._store.categories[self._store.category_codes[self._index]]
+    
+    @category.setter
+    def category(self, value: str):
+        self._store.category_codes[self._index] = self._store.category_code(value)
+    
+    def __repr__(self):
+        return f"ProductRow(id={self.id}, name={self.name!r})"
+
+class ColumnarProductStore(Sequence):
+    # Compact catalog representation: numeric fields live in typed arrays and
+    # categories are stored once in a table and referenced by code
+    def __init__(self):
+        self.ids = array("q")
+        self.prices = array("d")
+        self.stocks = array("q")
+        self.ratings = array("d")
+        self.versions = array("q")
+        self.category_codes = array("I")
+        self.names: List[str] = []
+        self.descriptions: List[str] = []
+        self.image_urls: List[str] = []
+        self.categories: List[str] = []
+        self._category_lookup: Dict[str, int] = {}
+    
+    @classmethod
+    def from_products(cls, products: Iterable[Product]) -> "ColumnarProductStore":
+        store = cls()
+        store.extend(products)
+        return store
+    
+    def category_code(self, category: str) -> int:
+        code = self._category_lookup.get(category)
+        if code is None:
+            code = self._category_lookup[category] = len(self.categories)
+            self.categories.append(sys.intern(category))
+        return code
+    
+    def append(self, product: Product):
+        self.ids.append(product.id)
+        self.prices.append(product.price)
+        self.stocks.append(product.stock)
+        self.ratings.append(product.rating)
+        self.versions.append(product.version)
+        self.category_codes.append(self.category_code(product.category))
+        self.names.append(product.name)
+        self.descriptions.append(product.description)
+        self.image_urls.append(product.image_url)
+    
+    def extend(self, products: Iterable[Product]):
+        for product in products:
+            self.append(product)
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ProductRow(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("product index out of range")
+        return ProductRow(self, index)
 
 @dataclass
 class CartItem:
     product: Product
     quantity: int
 
+def to_cents(price: float) -> int:
+    # Prices are stored as floats; money math is done in exact integer cents
+    return int((Decimal(str(price)) * 100).to_integral_value(ROUND_HALF_UP))
+
 class ShoppingCart:
+    # Keeps a running total (in cents) and item count so reads are O(1)
     def __init__(self):
         self.items: Dict[int, CartItem] = {}
+        self._unit_cents: Dict[int, int] = {}
+        self._total_cents: int = 0
+        self._items_count: int = 0
     
     def add_item(self, product: Product, quantity: int = 1):
         if product.id in self.items:
             self.items[product.id].quantity += quantity
         else:
             self.items[product.id] = CartItem(product, quantity)
+            self._unit_cents[product.id] = to_cents(product.price)
+        self._total_cents += self._unit_cents[product.id] * quantity
+        self._items_count += quantity
     
     def remove_item(self, product_id: int):
         if product_id in self.items:
-            del self.items[product_id]
+            item = self.items.pop(product_id)
+            self._total_cents -= self._unit_cents.pop(product_id) * item.quantity
+            self._items_count -= item.quantity
     
     def update_quantity(self, product_id: int, quantity: int):
         if product_id in self.items:
             if quantity <= 0:
                 self.remove_item(product_id)
             else:
-                self.items[product_id].quantity = quantity
+                item = self.items[product_id]
+                delta = quantity - item.quantity
+                item.quantity = quantity
+                self._total_cents += self._unit_cents[product_id] * delta
+                self._items_count += delta
+    
+    def reprice(self, product_id: int):
+        # Picks up a price change of a product already in the cart
+        if product_id in self.items:
+            item = self.items[product_id]
+            cents = to_cents(item.product.price)
+            self._total_cents += (cents - self._unit_cents[product_id]) * item.quantity
+            self._unit_cents[product_id] = cents
     
-    def get_total(self) -> float:
-        return sum(item.product.price * item.quantity for item in self.items.values())
+    def get_total(self) -> Decimal:
+        return Decimal(self._total_cents) / 100
     
     def get_items_count(self) -> int:
-        return sum(item.quantity for item in self.items.values())
+        return self._items_count
     
     def clear(self):
         self.items.clear()
+        self._unit_cents.clear()
+        self._total_cents = 0
+        self._items_count = 0
 
 @dataclass
 class User:
@@ -73,61 +232,2320 @@ class UserSession:
         self.current_user = None
         self.is_logged_in = False
 
-# ========== CONTROLLERS ==========
+def fold_text(text: str) -> str:
+    # Lowercase and strip accents so "Câmera" and "camera" compare equal
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
 
-class ProductController:
+# Search results kept per index, most recently used first
+SEARCH_CACHE_SIZE = 1024
+# Longest word prefix used for the fuzzy deletion dictionary
+FUZZY_PREFIX_LENGTH = 7
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    # Optimal string alignment distance (insertions, deletions,
+    # substitutions and adjacent transpositions), or limit + 1 once it is
+    # known to exceed `limit`
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+def allowed_typos(word: str) -> int:
+    return 0 if len(word) < 4 else 1 if len(word) < 8 else 2
+
+class SearchIndex:
+    # Trigram postings over the accent-folded name and description of each
+    # product. Every substring of length >= 3 is answered by intersecting
+    # postings; shorter queries are answered from the grams that contain them.
+    # Queries without matches are retried with misspelled words replaced by
+    # the closest indexed word (see correct()). Results are cached in an LRU
+    # that lives and dies with the index.
+    GRAM_SIZE = 3
+    
+    def __init__(self, products: Sequence[Product] = None, cache_size: int = SEARCH_CACHE_SIZE):
+        self.products: Sequence[Product] = []
+        self.names: List[str] = []
+        self.descriptions: List[str] = []
+        self.postings: Dict[str, List[int]] = {}
+        self.word_counts: Dict[str, int] = {}
+        self.cache_size = cache_size
+        self._short_query_cache: Dict[str, List[int]] = {}
+        self._cache: "OrderedDict[str, List[int]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._deletes: Optional[Dict[str, List[str]]] = None
+        if products:
+            self.build(products)
+    
+    @classmethod
+    def _grams(cls, text: str) -> Set[str]:
+        size = cls.GRAM_SIZE
+        return {text[i:i + size] for i in range(len(text) - size + 1)}
+    
+    @staticmethod
+    def _variants(word: str, distance: int) -> Set[str]:
+        # The word's prefix with up to `distance` characters deleted
+        variants = {word[:FUZZY_PREFIX_LENGTH]}
+        for _ in range(distance):
+            variants |= {v[:i] + v[i + 1:] for v in variants for i in range(len(v))}
+        return variants
+    
+    def build(self, products: Sequence[Product]):
+        # Kept by reference: a ColumnarProductStore builds rows on access
+        self.products = products
+        self.names = [fold_text(p.name) for p in products]
+        self.descriptions = [fold_text(p.description) for p in products]
+        self.postings = {}
+        self.word_counts = {}
+        self._short_query_cache = {}
+        self._deletes = None
+        self.clear_cache()
+        for position, (name, description) in enumerate(zip(self.names, self.descriptions)):
+            # Pad each field so that one- and two-character fields still produce grams
+            grams = self._grams(f"\x02{name}\x03") | self._grams(f"\x02{description}\x03")
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(position)
+            for word in re.findall(r"\w+", f"{name} {description}"):
+                # Numbers (model codes, sizes) are never corrected
+                if not word.isdigit():
+                    self.word_counts[word] = self.word_counts.get(word, 0) + 1
+    
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+    
+    def _deletion_dictionary(self) -> Dict[str, List[str]]:
+        # Built on the first misspelled query rather than with the index
+        deletes = self._deletes
+        if deletes is None:
+            deletes = {}
+            for word in self.word_counts:
+                for variant in self._variants(word, allowed_typos(word)):
+                    deletes.setdefault(variant, []).append(word)
+            self._deletes = deletes
+        return deletes
+    
+    def suggest(self, word: str) -> Optional[str]:
+        # The indexed word closest to `word` within allowed_typos(), the most
+        # frequent one on ties
+        limit = allowed_typos(word)
+        if not limit or word in self.word_counts:
+            return None
+        deletes = self._deletion_dictionary()
+        best, best_key = None, None
+        seen = set()
+        for variant in self._variants(word, limit):
+            for candidate in deletes.get(variant, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                distance = edit_distance(word, candidate, min(limit, allowed_typos(candidate)))
+                if distance <= limit and distance <= allowed_typos(candidate):
+                    key = (distance, -self.word_counts[candidate], candidate)
+                    if best_key is None or key < best_key:
+                        best, best_key = candidate, key
+        return best
+    
+    def correct(self, query: str) -> str:
+        # The folded query with every misspelled word replaced
+        words = re.findall(r"\w+", fold_text(query))
+        return " ".join(self.suggest(word) or word for word in words)
+    
+    def _candidates(self, query: str) -> List[int]:
+        if len(query) >= self.GRAM_SIZE:
+            lists = sorted(
+                (self.postings.get(gram, []) for gram in self._grams(query)), key=len
+            )
+            if not lists[0]:
+                return []
+            candidates = set(lists[0])
+            for postings in lists[1:]:
+                candidates.intersection_update(postings)
+                if not candidates:
+                    return []
+            return sorted(candidates)
+        if query not in self._short_query_cache:
+            candidates = set()
+            for gram, postings in self.postings.items():
+                if query in gram:
+                    candidates.update(postings)
+            self._short_query_cache[query] = sorted(candidates)
+        return self._short_query_cache[query]
+    
+    def _rank(self, text: str, position: int) -> int:
+        return 0 if position == 0 or not text[position - 1].isalnum() else 1
+    
+    def search(self, query: str) -> List[Product]:
+        return [self.products[position] for position in self.search_positions(query)]
+    
+    def search_positions(self, query: str) -> List[int]:
+        # Catalog positions of the matching products, best match first. The
+        # returned list is shared through the cache and must not be modified.
+        return self.search_bits(query)[0]
+    
+    def search_bits(self, query: str) -> Tuple[List[int], int]:
+        # search_positions() and the same positions as a bitset
+        query = fold_text(query)
+        if not query:
+            return list(range(len(self.products))), (1 << len(self.products)) - 1
+        with self._cache_lock:
+            result = self._cache.get(query)
+            if result is not None:
+                self._cache.move_to_end(query)
+                return result
+        ranked = self._match(query)
+        if not ranked:
+            corrected = self.correct(query)
+            if corrected and corrected != " ".join(re.findall(r"\w+", query)):
+                ranked = self._match(corrected)
+        result = ranked, bitset_from_positions(ranked, len(self.products))
+        with self._cache_lock:
+            self._cache[query] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+    
+    def _match(self, query: str) -> List[int]:
+        ranked = []
+        for position in self._candidates(query):
+            name = self.names[position]
+            found = name.find(query)
+            if found >= 0:
+                ranked.append(((0, self._rank(name, found), found, position), position))
+                continue
+            description = self.descriptions[position]
+            found = description.find(query)
+            if found >= 0:
+                ranked.append(((1, self._rank(description, found), found, position), position))
+        ranked.sort()
+        return [position for _, position in ranked]
+
+# Facet options offered next to the product grid
+PRICE_BANDS = [
+    ("0-50", "Até R$ 50", 0, 50),
+    ("50-200", "R$ 50 a R$ 200", 50, 200),
+    ("200-1000", "R$ 200 a R$ 1000", 200, 1000),
+    ("1000+", "Acima de R$ 1000", 1000, float("inf")),
+]
+RATING_THRESHOLDS = [4.5, 4.0, 3.0]
+
+def bitset_from_positions(positions: Iterable[int], size: int) -> int:
+    # Bitsets are plain ints with bit i set for catalog position i; building
+    # them through a bytearray keeps construction linear
+    data = bytearray((size + 7) // 8)
+    for position in positions:
+        data[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(data, "little")
+
+def bitset_from_mask(mask: np.ndarray) -> int:
+    # Bitset of the True entries of a boolean array
+    return int.from_bytes(np.packbits(mask, bitorder="little").tobytes(), "little")
+
+def mask_from_bitset(bits: int, size: int) -> np.ndarray:
+    data = np.frombuffer(bits.to_bytes((size + 7) // 8, "little"), np.uint8)
+    return np.unpackbits(data, count=size, bitorder="little").view(bool)
+
+def iter_bitset(bits: int) -> Iterator[int]:
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for index, byte in enumerate(data):
+        while byte:
+            lowest = byte & -byte
+            yield index * 8 + lowest.bit_length() - 1
+            byte ^= lowest
+
+@dataclass
+class FacetSelection:
+    category: str = "all"
+    price_band: Optional[str] = None
+    min_rating: Optional[float] = None
+    in_stock: bool = False
+    query: str = ""
+    sort: str = "relevancia"
+
+class ProductSelection(Sequence):
+    # Products whose positions are set in a bitset, materialized lazily so a
+    # page of results never walks past the bits it needs
+    def __init__(self, products: Sequence[Product], bits: int):
+        self.products = products
+        self.bits = bits
+        self._length = bits.bit_count()
+    
+    def __len__(self) -> int:
+        return self._length
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            return [self.products[position] for position in islice(iter_bitset(self.bits), start, stop, step)]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("selection index out of range")
+        return self.products[next(islice(iter_bitset(self.bits), index, None))]
+
+class RankedSelection(Sequence):
+    # Products at a list of catalog positions, e.g. cached search results
+    def __init__(self, products: Sequence[Product], positions: List[int]):
+        self.products = products
+        self.positions = positions
+    
+    def __len__(self) -> int:
+        return len(self.positions)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.products[position] for position in self.positions[index]]
+        return self.products[self.positions[index]]
+
+class FacetIndex:
+    # One bitset per facet option (category, price band, minimum rating, in
+    # stock). A filter is the AND of the selected options and a facet count
+    # is the popcount of the option ANDed with every other selected facet.
+    GROUPS = ("category", "price_band", "min_rating", "in_stock")
+    
+    def __init__(self, products: Sequence[Product] = ()):
+        size = len(products)
+        self.all = (1 << size) - 1
+        positions: Dict[str, Dict] = {
+            "category": {},
+            "price_band": {key: [] for key, _, _, _ in PRICE_BANDS},
+            "min_rating": {threshold: [] for threshold in RATING_THRESHOLDS},
+            "in_stock": {True: []},
+        }
+        for position, p in enumerate(products):
+            for group, key in self.option_keys(p):
+                positions[group].setdefault(key, []).append(position)
+        positions["category"] = dict(sorted(positions["category"].items()))
+        self.options: Dict[str, Dict] = {
+            group: {key: bitset_from_positions(keys, size) for key, keys in options.items()}
+            for group, options in positions.items()
+        }
+    
+    @staticmethod
+    def option_keys(p: Product) -> Iterator[Tuple[str, object]]:
+        # The (group, option) pairs a product belongs to
+        yield "category", fold_text(p.category)
+        for key, _, low, high in PRICE_BANDS:
+            if low <= p.price < high:
+                yield "price_band", key
+                break
+        for threshold in RATING_THRESHOLDS:
+            if p.rating >= threshold:
+                yield "min_rating", threshold
+        if p.stock > 0:
+            yield "in_stock", True
+    
+    def update(self, position: int, product: Product):
+        # Moves a changed product between options; only the bitsets whose
+        # membership actually changed are rebuilt
+        bit = 1 << position
+        member = set(self.option_keys(product))
+        category = fold_text(product.category)
+        if category not in self.options["category"]:
+            # Replaced rather than mutated so that readers never see it resize
+            self.options["category"] = dict(sorted({**self.options["category"], category: 0}.items()))
+        for group, options in self.options.items():
+            for key, bits in options.items():
+                wanted = (group, key) in member
+                if bool(bits & bit) != wanted:
+                    options[key] = bits | bit if wanted else bits & ~bit
+    
+    def _group_mask(self, group: str, selection: FacetSelection) -> int:
+        value = getattr(selection, group)
+        if group == "category":
+            value = None if value == "all" else fold_text(value)
+        if not value:
+            return self.all
+        return self.options[group].get(value, 0)
+    
+    def select(self, selection: FacetSelection, base: Optional[int] = None) -> Tuple[int, Dict[str, Dict]]:
+        base = self.all if base is None else base
+        masks = {group: self._group_mask(group, selection) for group in self.GROUPS}
+        counts = {}
+        for group in self.GROUPS:
+            others = base
+            for other, mask in masks.items():
+                if other != group:
+                    others &= mask
+            counts[group] = {key: (others & bits).bit_count() for key, bits in self.options[group].items()}
+        selected = base
+        for mask in masks.values():
+            selected &= mask
+        return selected, counts
+    
+    def mask(self, selection: FacetSelection) -> int:
+        # Like select() without the counts
+        selected = self.all
+        for group in self.GROUPS:
+            selected &= self._group_mask(group, selection)
+        return selected
+    
+    def with_sort_orders(self, sort_orders: "SortOrders", fields: Iterable[str]) -> "FacetIndex":
+        # Copy whose groups depending on the changed numeric `fields` are
+        # rebuilt from the new columns
+        def range_bits(field, low, high):
+            column = sort_orders.columns[field]
+            return bitset_from_mask((column >= low) & (column < high))
+        
+        facets = FacetIndex()
+        facets.all = self.all
+        facets.options = dict(self.options)
+        if "price" in fields:
+            facets.options["price_band"] = {key: range_bits("price", low, high) for key, _, low, high in PRICE_BANDS}
+        if "rating" in fields:
+            facets.options["min_rating"] = {
+                threshold: range_bits("rating", threshold, float("inf")) for threshold in RATING_THRESHOLDS
+            }
+        if "stock" in fields:
+            facets.options["in_stock"] = {True: range_bits("stock", 1, float("inf"))}
+        return facets
+
+# Sort options of the product grid: label, SortOrders field, descending
+SORT_OPTIONS = {
+    "relevancia": ("Relevância", None, False),
+    "menor_preco": ("Menor preço", "price", False),
+    "maior_preco": ("Maior preço", "price", True),
+    "avaliacao": ("Mais bem avaliados", "rating", True),
+    "nome": ("Nome (A-Z)", "name", False),
+    # Ids grow as products are added, so the highest ids are the newest
+    "novidades": ("Novidades", "id", True),
+}
+
+class SortOrders:
+    # Catalog positions ordered by each sortable field, ties broken by
+    # position. A changed product is moved within each order in place: its
+    # old slot is found by bisecting with the old key, which is still in
+    # the field's column, and the new one by insort. Numeric columns are
+    # NumPy arrays, so bulk updates compute over them without a Python loop.
+    FIELDS = ("price", "rating", "stock", "name", "id")
+    
+    def __init__(self, products: Sequence[Product] = ()):
+        count = len(products)
+        self.columns: Dict[str, Sequence] = {
+            "price": np.fromiter((p.price for p in products), np.float64, count),
+            "rating": np.fromiter((p.rating for p in products), np.float64, count),
+            "stock": np.fromiter((p.stock for p in products), np.int64, count),
+            "name": [fold_text(p.name) for p in products],
+            "id": np.fromiter((p.id for p in products), np.int64, count),
+        }
+        self.orders: Dict[str, array] = {field: self.argsort(column) for field, column in self.columns.items()}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def argsort(column: Sequence) -> array:
+        # Both sorts are stable, so equal keys stay in position order
+        if isinstance(column, np.ndarray):
+            return array("q", np.argsort(column, kind="stable").astype(np.int64).tobytes())
+        return array("q", sorted(range(len(column)), key=column.__getitem__))
+    
+    def key(self, field: str) -> Callable[[int], tuple]:
+        column = self.columns[field]
+        return lambda position: (column[position], position)
+    
+    def key_range(self, field: str, low, high) -> Tuple[int, int]:
+        # Slice of the order holding the keys in [low, high)
+        order, key = self.orders[field], self.key(field)
+        return bisect_left(order, (low, -1), key=key), bisect_left(order, (high, -1), key=key)
+    
+    def update(self, position: int, product: Product):
+        with self._lock:
+            for field, column in self.columns.items():
+                value = fold_text(product.name) if field == "name" else getattr(product, field)
+                if column[position] == value:
+                    continue
+                order, key = self.orders[field], self.key(field)
+                del order[bisect_left(order, key(position), key=key)]
+                column[position] = value
+                insort(order, position, key=key)
+    
+    def with_columns(self, columns: Dict[str, Sequence]) -> "SortOrders":
+        # Copy with some columns replaced; only their orders are sorted again
+        orders = SortOrders()
+        orders.columns = {**self.columns, **columns}
+        orders.orders = {
+            field: self.argsort(columns[field]) if field in columns else order
+            for field, order in self.orders.items()
+        }
+        return orders
+
+# Selections smaller than 1/NARROW_SELECTION_RATIO of the catalog are sorted
+# directly instead of walking the whole sort order
+NARROW_SELECTION_RATIO = 64
+
+class SortedSelection(Sequence):
+    # The products of a bitset (every product when None) in a precomputed
+    # sort order. Broad selections walk the order, keeping the positions
+    # whose bit is set, only as far as the requested slice needs; narrow
+    # ones sort their few positions by the same key. A `window` (see
+    # SortOrders.key_range) bounds the walk when the bits select a key range.
+    def __init__(self, products: Sequence[Product], orders: SortOrders, field: str,
+                 descending: bool = False, bits: Optional[int] = None, window: Tuple[int, int] = None):
+        self.products = products
+        self.order = orders.orders[field]
+        self.window = window or (0, len(self.order))
+        self.descending = descending
+        self.bits = bits
+        self._length = len(products) if bits is None else bits.bit_count()
+        self._found: List[int] = []
+        self._scanned = 0
+        if bits is not None:
+            self._data = bits.to_bytes((len(products) + 7) // 8, "little")
+            if self._length * NARROW_SELECTION_RATIO < len(products):
+                self._found = sorted(iter_bitset(bits), key=orders.key(field), reverse=descending)
+                self._scanned = len(self.order)
+    
+    def __len__(self) -> int:
+        return self._length
+    
+    def _positions(self, start: int, stop: int) -> Sequence[int]:
+        order, size = self.order, len(self.order)
+        if self.bits is None:
+            if self.descending:
+                return [order[size - 1 - index] for index in range(start, stop)]
+            return order[start:stop]
+        found, data, scanned = self._found, self._data, self._scanned
+        low, high = self.window
+        while len(found) < stop and scanned < high - low:
+            position = order[high - 1 - scanned] if self.descending else order[low + scanned]
+            if data[position >> 3] >> (position & 7) & 1:
+                found.append(position)
+            scanned += 1
+        self._scanned = scanned
+        return found[start:stop]
+    
+    def __getitem__(self, index):
+        products = self.products
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return [products[position] for position in self._positions(0, self._length)[index]]
+            return [products[position] for position in self._positions(start, max(start, stop))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("selection index out of range")
+        return products[self._positions(index, index + 1)[0]]
+
+# How long a featured selection is kept before rotating to the next one
+FEATURED_TTL_SECONDS = 10 * 60
+
+class FeaturedProductsProvider:
+    # Featured products are picked from the best rated products in stock.
+    # The selection is cached and rotates through that pool every `ttl`
+    # seconds, so renders read a precomputed list.
+    def __init__(self, catalog: "ProductCatalog", count: int = 3, pool_size: int = 12,
+                 ttl: float = FEATURED_TTL_SECONDS, clock: Callable[[], float] = time.time):
+        self.catalog = catalog
+        self.count = count
+        self.pool_size = pool_size
+        self.ttl = ttl
+        self.clock = clock
+        self._featured: List[Product] = []
+        self._expires_at = 0.0
+        self._source = None
+    
+    def _select(self, now: float) -> List[Product]:
+        pool = self.catalog.top_k("rating", self.pool_size, FacetSelection(in_stock=True))
+        if not pool:
+            return []
+        offset = int(now // self.ttl) * self.count
+        return [pool[(offset + i) % len(pool)] for i in range(min(self.count, len(pool)))]
+    
+    def get(self) -> List[Product]:
+        now = self.clock()
+        stale = (
+            now >= self._expires_at
+            or self._source is not self.catalog.products
+            or any(product.stock <= 0 for product in self._featured)
+        )
+        if stale:
+            self._featured = self._select(now)
+            self._expires_at = (now // self.ttl + 1) * self.ttl
+            self._source = self.catalog.products
+        return self._featured
+
+# Numeric fields of a bulk update with the normalization of their new
+# values, and the operations computing those from the current ones. Both
+# take and return NumPy arrays of the selected rows.
+BULK_UPDATE_FIELDS: Dict[str, Callable[[np.ndarray], np.ndarray]] = {
+    "price": lambda values: np.round(np.maximum(values, 0.0), 2),
+    "stock": lambda values: np.maximum(values.astype(np.int64), 0),
+    "rating": lambda values: np.round(np.clip(values, 0.0, 5.0), 1),
+}
+BULK_OPERATIONS: Dict[str, Callable[[np.ndarray, float], np.ndarray]] = {
+    "set": lambda values, operand: np.full(len(values), operand),
+    "add": np.add,
+    "multiply": np.multiply,
+}
+# Columns of ColumnarProductStore holding the bulk-updatable fields
+BULK_STORE_COLUMNS = {"price": "prices", "stock": "stocks", "rating": "ratings"}
+# Update batches of at least this many products (or 1/32 of a small
+# catalog) rebuild the indexes once instead of moving every product within
+# them; measured break-even was 300-750 updates from 20k to 300k products
+BULK_REINDEX_MIN_UPDATES = 500
+
+class ProductCatalog:
+    # Read-mostly product data shared by every connection, indexed by
+    # position: ids map to positions in `products`, so a ColumnarProductStore
+    # only builds a ProductRow for the products actually read. `version` counts
+    # every write; `generation` counts the index swaps (full loads and bulk
+    # updates), after which selections made earlier are stale.
     def __init__(self):
+        self.version = 0
+        self.generation = 0
+        self._write_lock = threading.Lock()
         self.products: List[Product] = []
-        self.filtered_products: List[Product] = []
-        self.current_category: str = "all"
+        self.positions: Dict[int, int] = {}
+        self.sort_orders = SortOrders()
+        self.changes = CatalogChangeFeed()
+        self.search_index = SearchIndex()
+        self.facets = FacetIndex()
+        self.featured = FeaturedProductsProvider(self)
+    
+    def load_products(self, products: Sequence[Product]):
+        # Indexes are built aside and swapped in together, so readers on other
+        # threads never see a half-built catalog
+        for p in products:
+            p.category = sys.intern(p.category)
+        positions = {p.id: position for position, p in enumerate(products)}
+        sort_orders = SortOrders(products)
+        search_index = SearchIndex(products)
+        facets = FacetIndex(products)
+        with self._write_lock:
+            self.products, self.positions, self.sort_orders, self.search_index, self.facets = (
+                products, positions, sort_orders, search_index, facets
+            )
+            self.version += 1
+            self.generation += 1
+    
+    def load_from_repository(self, repository: "ProductRepository", preload: int,
+                             compact: bool = False) -> threading.Thread:
+        # Load the first `preload` products right away so the first page can
+        # render, then stream the full catalog in on a background thread.
+        # With `compact` the products are stored in a ColumnarProductStore.
+        first_page = repository.fetch_page(0, preload)
+        self.load_products(ColumnarProductStore.from_products(first_page) if compact else first_page)
+        thread = threading.Thread(target=self._load_all, args=(repository, compact), daemon=True)
+        thread.start()
+        return thread
+    
+    def _load_all(self, repository: "ProductRepository", compact: bool = False):
+        products = ColumnarProductStore() if compact else []
+        for batch in repository.iter_batches():
+            products.extend(batch)
+        self.load_products(products)
+    
+    def get(self, product_id: int) -> Optional[Product]:
+        position = self.positions.get(product_id)
+        return None if position is None else self.products[position]
+    
+    def top_k(self, field: str, k: int, selection: FacetSelection = None, descending: bool = True) -> List[Product]:
+        # First k products of the selection by `field`, e.g. the best rated
+        bits = self.facets.mask(selection) if selection is not None else None
+        return SortedSelection(self.products, self.sort_orders, field, descending, bits)[:k]
+    
+    def refresh(self, product: Product):
+        # Re-indexes a product changed in place (stock, price, rating...)
+        position = self.positions.get(product.id)
+        # Compared by id: with COMPACT_CATALOG every access builds a new ProductRow
+        if position is not None and self.products[position].id == product.id:
+            self.sort_orders.update(position, product)
+            self.facets.update(position, product)
+    
+    def apply_updates(self, updates: List["ProductUpdate"], replicate: bool = True) -> List["ProductUpdate"]:
+        # Applies the updates, re-indexes the products and publishes the
+        # applied updates on `changes`. With a shared backend, local updates
+        # are logged and then applied from the log, in log order, like the
+        # other processes' (which are replayed with replicate=False).
+        backend = self.changes.backend
+        if replicate and backend is not None:
+            backend.publish(updates)
+            backend.sync(self)
+            return updates
+        with self._write_lock:
+            applied = self._apply_locked(updates)
+        if applied:
+            self.changes.publish(applied)
+        return applied
+    
+    def _apply_locked(self, updates: Iterable["ProductUpdate"]) -> List["ProductUpdate"]:
+        # Deltas are resolved against the current values here, under the
+        # write lock. Updates are applied when newer than the product's
+        # version, except deltas, which come from checkouts that must not be
+        # lost, and logged updates, which come in log order.
+        for update in updates:
+            for field in chain(update.changes, update.deltas):
+                if field not in PRODUCT_UPDATE_FIELDS or (field in update.deltas and field != "stock"):
+                    raise ValueError(f"Field {field!r} cannot be updated")
+        applied, resolved = [], []
+        versions: Dict[int, int] = {}
+        stocks: Dict[int, int] = {}
+        for update in updates:
+            product = self.get(update.product_id)
+            if product is None:
+                continue
+            version = versions.get(update.product_id, product.version)
+            if update.seq is None and not update.deltas and update.version <= version:
+                continue
+            changes = update.changes
+            if update.deltas:
+                changes = {**changes, "stock": stocks.get(update.product_id, product.stock) + update.deltas["stock"]}
+            if "stock" in changes:
+                stocks[update.product_id] = changes["stock"]
+            versions[update.product_id] = max(update.version, version + 1)
+            applied.append(update)
+            resolved.append(ProductUpdate(update.product_id, versions[update.product_id], changes))
+        if not applied:
+            return applied
+        self.version += 1
+        if len(resolved) > 1 and len(resolved) >= min(BULK_REINDEX_MIN_UPDATES, len(self.products) // 32):
+            self._swap_in(resolved, *self._reindexed(resolved))
+        else:
+            for update in resolved:
+                product = self.get(update.product_id)
+                for field, value in update.changes.items():
+                    setattr(product, field, value)
+                product.version = update.version
+                self.refresh(product)
+        return applied
+    
+    def adjust_stock(self, deltas: Dict[int, int]) -> List["ProductUpdate"]:
+        # Adds each delta to its product's stock, all or nothing: raises
+        # OutOfStockError if any stock would go negative, or
+        # ProductUnavailableError if a product left the catalog. Replicated as
+        # deltas, so sales in several processes add up. With a shared
+        # backend the database checks and logs the sale, outside the write
+        # lock, and the sale is then applied from the log.
+        for product_id in deltas:
+            if product_id not in self.positions:
+                raise ProductUnavailableError(product_id)
+        updates = [ProductUpdate(product_id, 0, {}, {"stock": delta}) for product_id, delta in deltas.items()]
+        backend = self.changes.backend
+        if backend is not None:
+            backend.take_stock(updates, {product_id: self.get(product_id).stock for product_id in deltas})
+            backend.sync(self)
+            return updates
+        with self._write_lock:
+            for product_id, delta in deltas.items():
+                if self.get(product_id).stock + delta < 0:
+                    raise OutOfStockError(product_id)
+            applied = self._apply_locked(updates)
+        self.changes.publish(applied)
+        return applied
+    
+    def bulk_update(self, selection: FacetSelection = None, where: Dict[str, Tuple] = None,
+                    replicate: bool = True, **operations: Tuple[str, float]) -> Optional["BulkUpdate"]:
+        # Applies BULK_OPERATIONS to the products matching the facet
+        # selection and the [low, high) ranges of sortable fields in `where`:
+        #   bulk_update(FacetSelection(category="eletronicos"), price=("multiply", 0.9))
+        #   bulk_update(where={"stock": (0, 10)}, stock=("add", 100))
+        # New values are computed over the columns and the re-indexed catalog
+        # is swapped in at once. A write landing in the meantime makes it
+        # compute again from the new values. With a shared backend the call
+        # is logged as one BulkUpdate, which every process replays from the
+        # log, this one included.
+        for field, (operation, _) in operations.items():
+            if field not in BULK_UPDATE_FIELDS or operation not in BULK_OPERATIONS:
+                raise ValueError(f"Unsupported bulk operation {operation!r} on {field!r}")
+        selection, where = selection or FacetSelection(), where or {}
+        backend = self.changes.backend
+        if replicate and backend is not None:
+            changed, columns = self._bulk_columns(selection, where, operations)
+            if not columns:
+                return None
+            bulk = BulkUpdate(selection, where, operations, self.sort_orders.columns["id"][changed])
+            backend.publish_bulk(bulk)
+            backend.sync(self)
+            return bulk
+        while True:
+            version = self.version
+            changed, columns = self._bulk_columns(selection, where, operations)
+            if not columns:
+                return None
+            sort_orders = self.sort_orders.with_columns(columns)
+            facets = self.facets.with_sort_orders(sort_orders, columns)
+            with self._write_lock:
+                if self.version == version:
+                    self.version += 1
+                    self._swap_in_columns(np.flatnonzero(changed), columns, sort_orders, facets)
+                    break
+        bulk = BulkUpdate(selection, where, operations, sort_orders.columns["id"][changed])
+        self.changes.publish_bulk(bulk)
+        return bulk
+    
+    def _bulk_columns(self, selection: FacetSelection, where: Dict[str, Tuple],
+                      operations: Dict[str, Tuple[str, float]]) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        # The rows whose values change and the new columns of the changed fields
+        sort_orders, size = self.sort_orders, len(self.products)
+        bits = self.facets.mask(selection)
+        if selection.query:
+            bits &= self.search_index.search_bits(selection.query)[1]
+        selected = mask_from_bitset(bits, size)
+        for field, (low, high) in where.items():
+            column = sort_orders.columns[field]
+            selected &= (column >= low) & (column < high)
+        changed = np.zeros(size, bool)
+        columns: Dict[str, np.ndarray] = {}
+        for field, (operation, operand) in operations.items():
+            current = sort_orders.columns[field]
+            values = current.copy()
+            values[selected] = BULK_UPDATE_FIELDS[field](BULK_OPERATIONS[operation](current[selected], operand))
+            differs = values != current
+            if differs.any():
+                columns[field] = values
+                changed |= differs
+        return changed, columns
+    
+    def _swap_in_columns(self, positions: np.ndarray, columns: Dict[str, np.ndarray],
+                         sort_orders: SortOrders, facets: FacetIndex):
+        # Called with the write lock held. A ColumnarProductStore is written
+        # column by column; Product objects still need one setattr per row.
+        products = self.products
+        if isinstance(products, ColumnarProductStore):
+            for field, values in columns.items():
+                column = getattr(products, BULK_STORE_COLUMNS[field])
+                np.frombuffer(column, values.dtype)[positions] = values[positions]
+            np.frombuffer(products.versions, np.int64)[positions] += 1
+        else:
+            rows = [products[position] for position in positions.tolist()]
+            for field, values in columns.items():
+                for product, value in zip(rows, values[positions].tolist()):
+                    setattr(product, field, value)
+            for product in rows:
+                product.version += 1
+        self.sort_orders, self.facets = sort_orders, facets
+        self.generation += 1
+    
+    def _reindexed(self, updates: List["ProductUpdate"]) -> Tuple[SortOrders, FacetIndex]:
+        # Sort orders and facets with the updates applied, built aside from
+        # copies of the changed columns
+        columns: Dict[str, Sequence] = {}
+        for update in updates:
+            position = self.positions[update.product_id]
+            for field, value in update.changes.items():
+                if field not in self.sort_orders.columns:
+                    continue
+                if field not in columns:
+                    columns[field] = self.sort_orders.columns[field].copy()
+                columns[field][position] = value
+        sort_orders = self.sort_orders.with_columns(columns)
+        return sort_orders, self.facets.with_sort_orders(sort_orders, columns)
+    
+    def _swap_in(self, updates: List["ProductUpdate"], sort_orders: SortOrders, facets: FacetIndex):
+        # Called with the write lock held
+        for update in updates:
+            product = self.get(update.product_id)
+            for field, value in update.changes.items():
+                setattr(product, field, value)
+            product.version = update.version
+        self.sort_orders, self.facets = sort_orders, facets
+        self.generation += 1
+    
+    def update_product(self, product_id: int, **changes) -> Optional["ProductUpdate"]:
+        # Local change to one product, e.g. update_product(1, price=799.9).
+        # The version is taken under the write lock, so it can't be stale.
+        if product_id not in self.positions:
+            return None
+        if self.changes.backend is not None:
+            return self.apply_updates([ProductUpdate(product_id, 0, changes)])[0]
+        with self._write_lock:
+            applied = self._apply_locked([ProductUpdate(product_id, self.get(product_id).version + 1, changes)])
+        self.changes.publish(applied)
+        return applied[0]
+    
+    def categories(self) -> List[str]:
+        return list(self.facets.options["category"])
+    
+    def search(self, query: str) -> List[Product]:
+        return self.search_index.search(query)
+    
+    def select(self, selection: FacetSelection) -> Tuple[Sequence[Product], Dict[str, Dict]]:
+        # Products matching the search query and every selected facet, plus
+        # the facet counts. Search results keep their ranking unless another
+        # sort is selected.
+        products, search_index, facets = self.products, self.search_index, self.facets
+        _, field, descending = SORT_OPTIONS.get(selection.sort, SORT_OPTIONS["relevancia"])
+        window = None
+        if field == "price" and selection.price_band:
+            # Only the price band's stretch of the price order can match
+            for key, _, low, high in PRICE_BANDS:
+                if key == selection.price_band:
+                    window = self.sort_orders.key_range("price", low, high)
+        if not selection.query:
+            bits, counts = facets.select(selection)
+            if field is not None:
+                bits = None if bits == facets.all else bits
+                return SortedSelection(products, self.sort_orders, field, descending, bits, window), counts
+            if bits == facets.all:
+                return products, counts
+            return ProductSelection(products, bits), counts
+        ranked, matches = search_index.search_bits(selection.query)
+        bits, counts = facets.select(selection, matches)
+        if field is not None:
+            return SortedSelection(products, self.sort_orders, field, descending, bits, window), counts
+        if bits == matches:
+            return RankedSelection(products, ranked), counts
+        data = bits.to_bytes((len(products) + 7) // 8, "little")
+        return [
+            products[position] for position in ranked if data[position >> 3] >> (position & 7) & 1
+        ], counts
+
+# ========== REPOSITORIES ==========
+
+class ProductRepository:
+    # Storage backend the catalog is loaded from
+    def count(self) -> int:
+        raise NotImplementedError
+    
+    def fetch_page(self, offset: int, limit: int) -> List[Product]:
+        raise NotImplementedError
+    
+    def iter_batches(self, batch_size: int = 1000) -> Iterator[List[Product]]:
+        raise NotImplementedError
+    
+    def add_products(self, products: Iterable[Product]):
+        raise NotImplementedError
+
+class InMemoryProductRepository(ProductRepository):
+    def __init__(self, products: Iterable[Product] = ()):
+        self.products: List[Product] = list(products)
+    
+    def count(self) -> int:
+        return len(self.products)
+    
+    def fetch_page(self, offset: int, limit: int) -> List[Product]:
+        return self.products[offset:offset + limit]
+    
+    def iter_batches(self, batch_size: int = 1000) -> Iterator[List[Product]]:
+        for start in range(0, len(self.products), batch_size):
+            yield self.products[start:start + batch_size]
+    
+    def add_products(self, products: Iterable[Product]):
+        self.products.extend(products)
+
+class SQLiteProductRepository(ProductRepository):
+    # Reference backend. Statements are module constants so sqlite3's
+    # per-connection statement cache prepares each of them only once.
+    COLUMNS = ("id", "name", "description", "price", "image_url", "category", "stock", "rating", "version")
+    CREATE_SQL = """
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            description TEXT NOT NULL,
+            price REAL NOT NULL,
+            image_url TEXT NOT NULL,
+            category TEXT NOT NULL,
+            stock INTEGER NOT NULL,
+            rating REAL NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """
+    SELECT_SQL = f"SELECT {', '.join(COLUMNS)} FROM products ORDER BY id"
+    PAGE_SQL = SELECT_SQL + " LIMIT ? OFFSET ?"
+    COUNT_SQL = "SELECT COUNT(*) FROM products"
+    UPSERT_SQL = (
+        f"INSERT OR REPLACE INTO products ({', '.join(COLUMNS)}) "
+        f"VALUES ({', '.join('?' for _ in COLUMNS)})"
+    )
+    
+    def __init__(self, path: str, pool_size: int = 4):
+        self.path = path
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(sqlite3.connect(path, check_same_thread=False, cached_statements=64))
+        with self.connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(self.CREATE_SQL)
+    
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self._pool.get()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._pool.put(conn)
+    
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+    
+    @staticmethod
+    def _to_product(row: tuple) -> Product:
+        return Product(*row)
+    
+    def count(self) -> int:
+        with self.connection() as conn:
+            return conn.execute(self.COUNT_SQL).fetchone()[0]
+    
+    def fetch_page(self, offset: int, limit: int) -> List[Product]:
+        with self.connection() as conn:
+            return [self._to_product(row) for row in conn.execute(self.PAGE_SQL, (limit, offset))]
+    
+    def iter_batches(self, batch_size: int = 1000) -> Iterator[List[Product]]:
+        with self.connection() as conn:
+            cursor = conn.execute(self.SELECT_SQL)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [self._to_product(row) for row in rows]
+    
+    def add_products(self, products: Iterable[Product], batch_size: int = 5000):
+        self._insert_rows(
+            (
+                (p.id, p.name, p.description, p.price, p.image_url, p.category, p.stock, p.rating, p.version)
+                for p in products
+            ),
+            batch_size
+        )
+    
+    def _insert_rows(self, rows: Iterable[tuple], batch_size: int):
+        # One transaction per batch keeps memory flat on very large imports
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            with self.connection() as conn:
+                conn.executemany(self.UPSERT_SQL, batch)
+    
+    def _record_to_row(self, record: Dict[str, str]) -> tuple:
+        return (
+            int(record["id"]),
+            record["name"],
+            record["description"],
+            float(record["price"]),
+            record["image_url"],
+            record["category"],
+            int(record["stock"]),
+            float(record.get("rating") or 0),
+            int(record.get("version") or 0)
+        )
+    
+    def import_csv(self, path: str, batch_size: int = 5000):
+        with open(path, newline="", encoding="utf-8") as file:
+            self._insert_rows(map(self._record_to_row, csv.DictReader(file)), batch_size)
+    
+    def import_jsonl(self, path: str, batch_size: int = 5000):
+        with open(path, encoding="utf-8") as file:
+            records = (json.loads(line) for line in file if line.strip())
+            self._insert_rows(map(self._record_to_row, records), batch_size)
+
+# Sessions not saved for this long are expired
+SESSION_TTL = 30 * 24 * 3600
+
+class SessionStore:
+    # Per-client cart and login state, shared by every server worker.
+    # Sessions not saved for `ttl` seconds load as None and are deleted.
+    def load(self, session_id: str) -> Optional[Dict]:
+        raise NotImplementedError
+    
+    def save(self, session_id: str, data: Dict):
+        raise NotImplementedError
+    
+    def delete(self, session_id: str):
+        raise NotImplementedError
+    
+    def expire(self):
+        # Deletes every expired session
+        raise NotImplementedError
+
+class InMemorySessionStore(SessionStore):
+    # Only shared within one process; use SQLiteSessionStore for several workers
+    def __init__(self, ttl: float = SESSION_TTL):
+        self.ttl = ttl
+        self.sessions: Dict[str, Tuple[float, str]] = {}
+    
+    def load(self, session_id: str) -> Optional[Dict]:
+        entry = self.sessions.get(session_id)
+        if entry is None:
+            return None
+        if entry[0] <= time.time() - self.ttl:
+            self.delete(session_id)
+            return None
+        return json.loads(entry[1])
+    
+    def save(self, session_id: str, data: Dict):
+        self.sessions[session_id] = (time.time(), json.dumps(data))
+    
+    def delete(self, session_id: str):
+        self.sessions.pop(session_id, None)
+    
+    def expire(self):
+        cutoff = time.time() - self.ttl
+        for session_id in [key for key, (updated_at, _) in self.sessions.items() if updated_at <= cutoff]:
+            self.delete(session_id)
+
+class SQLiteSessionStore(SessionStore):
+    CREATE_SQL = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """
+    INDEX_SQL = "CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)"
+    LOAD_SQL = "SELECT data, updated_at FROM sessions WHERE id = ?"
+    SAVE_SQL = "INSERT OR REPLACE INTO sessions (id, data, updated_at) VALUES (?, ?, ?)"
+    DELETE_SQL = "DELETE FROM sessions WHERE id = ?"
+    EXPIRE_SQL = "DELETE FROM sessions WHERE updated_at <= ?"
+    
+    def __init__(self, path: str, ttl: float = SESSION_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(self.CREATE_SQL)
+            self._conn.execute(self.INDEX_SQL)
+    
+    def load(self, session_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(self.LOAD_SQL, (session_id,)).fetchone()
+        if row is None:
+            return None
+        if row[1] <= time.time() - self.ttl:
+            self.delete(session_id)
+            return None
+        return json.loads(row[0])
+    
+    def save(self, session_id: str, data: Dict):
+        with self._lock, self._conn:
+            self._conn.execute(self.SAVE_SQL, (session_id, json.dumps(data), time.time()))
+    
+    def delete(self, session_id: str):
+        with self._lock, self._conn:
+            self._conn.execute(self.DELETE_SQL, (session_id,))
+    
+    def expire(self):
+        with self._lock, self._conn:
+            self._conn.execute(self.EXPIRE_SQL, (time.time() - self.ttl,))
+
+class CartLog:
+    # Append-only log of cart operations per session. Every operation gets
+    # the next version of its cart; compact() folds the operations up to a
+    # version into a snapshot so replaying a cart stays short.
+    def append(self, session_id: str, version: int, op: List) -> bool:
+        # False when `version` was already taken by another replica of the cart
+        raise NotImplementedError
+    
+    def load(self, session_id: str) -> Tuple[int, Dict[str, int], List[Tuple[int, List]]]:
+        # Latest snapshot (version, items) and the operations recorded after it
+        raise NotImplementedError
+    
+    def ops_since(self, session_id: str, version: int) -> Optional[List[Tuple[int, List]]]:
+        # None when the operations after `version` were compacted away
+        raise NotImplementedError
+    
+    def compact(self, session_id: str, version: int, items: Dict[str, int]):
+        raise NotImplementedError
+
+class InMemoryCartLog(CartLog):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops: Dict[str, List[Tuple[int, List]]] = {}
+        self._snapshots: Dict[str, Tuple[int, Dict[str, int]]] = {}
+    
+    def _last_version(self, session_id: str) -> int:
+        ops = self._ops.get(session_id)
+        return ops[-1][0] if ops else self._snapshots.get(session_id, (0, {}))[0]
+    
+    def append(self, session_id: str, version: int, op: List) -> bool:
+        with self._lock:
+            if version != self._last_version(session_id) + 1:
+                return False
+            self._ops.setdefault(session_id, []).append((version, op))
+            return True
+    
+    def load(self, session_id: str) -> Tuple[int, Dict[str, int], List[Tuple[int, List]]]:
+        with self._lock:
+            version, items = self._snapshots.get(session_id, (0, {}))
+            return version, dict(items), list(self._ops.get(session_id, []))
+    
+    def ops_since(self, session_id: str, version: int) -> Optional[List[Tuple[int, List]]]:
+        with self._lock:
+            if version < self._snapshots.get(session_id, (0, {}))[0]:
+                return None
+            return [entry for entry in self._ops.get(session_id, []) if entry[0] > version]
+    
+    def compact(self, session_id: str, version: int, items: Dict[str, int]):
+        with self._lock:
+            if version <= self._snapshots.get(session_id, (0, {}))[0]:
+                return
+            self._snapshots[session_id] = (version, dict(items))
+            self._ops[session_id] = [entry for entry in self._ops.get(session_id, []) if entry[0] > version]
+
+class SQLiteCartLog(CartLog):
+    # Can share the database file of SQLiteSessionStore
+    CREATE_SQL = (
+        """
+        CREATE TABLE IF NOT EXISTS cart_ops (
+            session_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            PRIMARY KEY (session_id, version)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS cart_snapshots (
+            session_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            items TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """,
+    )
+    LAST_VERSION_SQL = "SELECT MAX(version) FROM cart_ops WHERE session_id = ?"
+    APPEND_SQL = "INSERT INTO cart_ops (session_id, version, op) VALUES (?, ?, ?)"
+    SNAPSHOT_SQL = "SELECT version, items FROM cart_snapshots WHERE session_id = ?"
+    OPS_SQL = "SELECT version, op FROM cart_ops WHERE session_id = ? AND version > ? ORDER BY version"
+    COMPACT_SQL = """
+        INSERT INTO cart_snapshots (session_id, version, items, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT (session_id) DO UPDATE SET
+            version = excluded.version, items = excluded.items, updated_at = excluded.updated_at
+        WHERE excluded.version > cart_snapshots.version
+    """
+    PRUNE_SQL = "DELETE FROM cart_ops WHERE session_id = ? AND version <= ?"
+    
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            for statement in self.CREATE_SQL:
+                self._conn.execute(statement)
+    
+    def _snapshot(self, session_id: str) -> Tuple[int, Dict[str, int]]:
+        row = self._conn.execute(self.SNAPSHOT_SQL, (session_id,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else (0, {})
+    
+    def _ops_after(self, session_id: str, version: int) -> List[Tuple[int, List]]:
+        return [(v, json.loads(op)) for v, op in self._conn.execute(self.OPS_SQL, (session_id, version))]
+    
+    def append(self, session_id: str, version: int, op: List) -> bool:
+        # The write lock is taken up front so that two workers cannot both
+        # see the same last version
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(self.LAST_VERSION_SQL, (session_id,)).fetchone()
+            last = row[0] if row[0] is not None else self._snapshot(session_id)[0]
+            if version != last + 1:
+                return False
+            self._conn.execute(self.APPEND_SQL, (session_id, version, json.dumps(op)))
+        return True
+    
+    def load(self, session_id: str) -> Tuple[int, Dict[str, int], List[Tuple[int, List]]]:
+        # Read in one transaction so a concurrent compaction cannot drop
+        # operations between the snapshot and the log reads
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            version, items = self._snapshot(session_id)
+            return version, items, self._ops_after(session_id, version)
+    
+    def ops_since(self, session_id: str, version: int) -> Optional[List[Tuple[int, List]]]:
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            if version < self._snapshot(session_id)[0]:
+                return None
+            return self._ops_after(session_id, version)
+    
+    def compact(self, session_id: str, version: int, items: Dict[str, int]):
+        with self._lock, self._conn:
+            self._conn.execute(self.COMPACT_SQL, (session_id, version, json.dumps(items), time.time()))
+            self._conn.execute(self.PRUNE_SQL, (session_id, version))
+
+# How often each process exchanges catalog updates with the others, and how
+# long the updates are kept for processes that fall behind
+CATALOG_SYNC_INTERVAL_SECONDS = 0.2
+CATALOG_UPDATE_RETENTION_SECONDS = 60 * 60
+
+class SQLiteCatalogUpdates:
+    # Cross-process backend of CatalogChangeFeed. Every update is written
+    # to a log, which gives it its seq, and every process applies the log
+    # to its own catalog in seq order: its own updates right after writing
+    # them, the others' from a background thread. So all the catalogs end
+    # with the same values, whichever process wrote last. Can share the
+    # database file of SQLiteSessionStore. The stock of the sold products is
+    # also kept in the database, where checkouts decrement it in the
+    # transaction that logs them, so that processes can't oversell.
+    CREATE_SQL = """
+        CREATE TABLE IF NOT EXISTS catalog_updates (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            changes TEXT NOT NULL,
+            deltas TEXT NOT NULL DEFAULT '{}',
+            bulk TEXT,
+            created_at REAL NOT NULL
+        )
+    """
+    INSERT_SQL = (
+        "INSERT INTO catalog_updates (origin, product_id, version, changes, deltas, bulk, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)"
+    )
+    LAST_SEQ_SQL = "SELECT COALESCE(MAX(seq), 0) FROM catalog_updates"
+    SINCE_SQL = "SELECT seq, product_id, version, changes, deltas, bulk FROM catalog_updates WHERE seq > ? ORDER BY seq"
+    PRUNE_SQL = "DELETE FROM catalog_updates WHERE created_at < ?"
+    STOCK_CREATE_SQL = """
+        CREATE TABLE IF NOT EXISTS catalog_stock (
+            product_id INTEGER PRIMARY KEY,
+            stock INTEGER NOT NULL
+        )
+    """
+    STOCK_SEED_SQL = "INSERT OR IGNORE INTO catalog_stock (product_id, stock) VALUES (?, ?)"
+    STOCK_SET_SQL = "INSERT OR REPLACE INTO catalog_stock (product_id, stock) VALUES (?, ?)"
+    STOCK_TAKE_SQL = "UPDATE catalog_stock SET stock = stock + ? WHERE product_id = ? AND stock + ? >= 0"
+    STOCK_SOLD_SQL = "SELECT product_id FROM catalog_stock"
+    # Bulk stock operations on the shared stock, so a restock adds to the
+    # stock left after concurrent sales rather than overwriting it
+    STOCK_BULK_SQL = {
+        "set": "UPDATE catalog_stock SET stock = MAX(CAST(? AS INTEGER), 0) WHERE product_id = ?",
+        "add": "UPDATE catalog_stock SET stock = MAX(CAST(stock + ? AS INTEGER), 0) WHERE product_id = ?",
+        "multiply": "UPDATE catalog_stock SET stock = MAX(CAST(stock * ? AS INTEGER), 0) WHERE product_id = ?",
+    }
+    
+    def __init__(self, path: str, interval: float = CATALOG_SYNC_INTERVAL_SECONDS):
+        self.origin = uuid4().hex
+        self.interval = interval
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(self.CREATE_SQL)
+            self._conn.execute(self.STOCK_CREATE_SQL)
+            # Databases created before stock deltas were replicated
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(catalog_updates)")}
+            if "deltas" not in columns:
+                self._conn.execute("ALTER TABLE catalog_updates ADD COLUMN deltas TEXT NOT NULL DEFAULT '{}'")
+            if "bulk" not in columns:
+                self._conn.execute("ALTER TABLE catalog_updates ADD COLUMN bulk TEXT")
+        self._last_seq = self._conn.execute(self.LAST_SEQ_SQL).fetchone()[0]
+        self._stopped = threading.Event()
+        # The connection is shared by the sync thread and the writers; the
+        # log is applied by one thread at a time
+        self._conn_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+    
+    def _log(self, update: "ProductUpdate"):
+        update.seq = self._conn.execute(self.INSERT_SQL, (
+            self.origin, update.product_id, update.version, json.dumps(update.changes),
+            json.dumps(update.deltas), None, time.time()
+        )).lastrowid
+    
+    def publish(self, updates: List["ProductUpdate"]):
+        # Logs the updates, setting their seq, and writes absolute stock
+        # through to the shared stock in the same transaction
+        with self._conn_lock, self._conn:
+            for update in updates:
+                if "stock" in update.changes:
+                    self._conn.execute(self.STOCK_SET_SQL, (update.product_id, update.changes["stock"]))
+                self._log(update)
+    
+    def publish_bulk(self, bulk: "BulkUpdate"):
+        with self._conn_lock, self._conn:
+            if "stock" in bulk.operations:
+                operation, operand = bulk.operations["stock"]
+                sold = np.fromiter((row[0] for row in self._conn.execute(self.STOCK_SOLD_SQL)), np.int64)
+                product_ids = bulk.product_ids[np.isin(bulk.product_ids, sold)].tolist()
+                self._conn.executemany(self.STOCK_BULK_SQL[operation], zip(repeat(operand), product_ids))
+            self._conn.execute(self.INSERT_SQL, (self.origin, 0, 0, "{}", "{}", bulk.to_json(), time.time()))
+    
+    def take_stock(self, updates: List["ProductUpdate"], stocks: Dict[int, int]):
+        # Adds the stock deltas of the updates to the shared stock and logs
+        # them in one transaction, raising OutOfStockError and changing
+        # nothing if one would go negative. `stocks` seeds the products no
+        # process has sold yet.
+        with self._conn_lock, self._conn:
+            self._conn.executemany(self.STOCK_SEED_SQL, stocks.items())
+            for update in updates:
+                delta = update.deltas["stock"]
+                if self._conn.execute(self.STOCK_TAKE_SQL, (delta, update.product_id, delta)).rowcount == 0:
+                    raise OutOfStockError(update.product_id)
+                self._log(update)
+    
+    def prune(self):
+        try:
+            with self._conn_lock, self._conn:
+                self._conn.execute(self.PRUNE_SQL, (time.time() - CATALOG_UPDATE_RETENTION_SECONDS,))
+        except sqlite3.OperationalError:
+            # Database busy: prune on the next exchange
+            pass
+    
+    def sync(self, catalog: "ProductCatalog"):
+        # Applies the updates logged since the last sync, in seq order
+        with self._sync_lock:
+            with self._conn_lock:
+                rows = self._conn.execute(self.SINCE_SQL, (self._last_seq,)).fetchall()
+            self._apply_rows(catalog, rows)
+    
+    def _apply_rows(self, catalog: "ProductCatalog", rows: List[tuple]):
+        incoming = []
+        for seq, product_id, version, changes, deltas, bulk in rows:
+            if bulk is None:
+                incoming.append(ProductUpdate(product_id, version, json.loads(changes), json.loads(deltas), seq))
+            else:
+                # Applied in order: the row updates logged before it first
+                if incoming:
+                    catalog.apply_updates(incoming, replicate=False)
+                    incoming = []
+                bulk = BulkUpdate.from_json(bulk)
+                catalog.bulk_update(bulk.selection, bulk.where, replicate=False, **bulk.operations)
+            self._last_seq = seq
+        if incoming:
+            catalog.apply_updates(incoming, replicate=False)
+    
+    def start(self, catalog: "ProductCatalog") -> threading.Thread:
+        def run():
+            while not self._stopped.wait(self.interval):
+                self.prune()
+                self.sync(catalog)
+        
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+    
+    def stop(self):
+        self._stopped.set()
+
+# ========== SERVICES ==========
+
+# Product fields that live updates may change. Fields that the search index
+# and the category lists depend on need a full load_products().
+PRODUCT_UPDATE_FIELDS = ("price", "stock", "rating", "image_url")
+# Changes published within one tick are delivered to subscribers together
+CATALOG_UPDATE_TICK_SECONDS = 0.05
+
+@dataclass
+class ProductUpdate:
+    product_id: int
+    version: int
+    changes: Dict[str, object]
+    # Amounts added to the current values (only "stock", by checkouts)
+    deltas: Dict[str, int] = field(default_factory=dict)
+    # Position in the log shared by the processes (SQLiteCatalogUpdates),
+    # which every process applies in the same order; None without one
+    seq: Optional[int] = None
+
+@dataclass
+class BulkUpdate:
+    # One ProductCatalog.bulk_update() call, published as a single record:
+    # other processes replay the operations rather than receive every row
+    selection: FacetSelection
+    where: Dict[str, Tuple]
+    operations: Dict[str, Tuple[str, float]]
+    # Ids of the products changed here (not replicated)
+    product_ids: np.ndarray = None
+    
+    def to_json(self) -> str:
+        return json.dumps({"selection": vars(self.selection), "where": self.where, "operations": self.operations})
+    
+    @classmethod
+    def from_json(cls, text: str) -> "BulkUpdate":
+        data = json.loads(text)
+        return cls(
+            FacetSelection(**data["selection"]),
+            {field: tuple(bounds) for field, bounds in data["where"].items()},
+            {field: tuple(operation) for field, operation in data["operations"].items()},
+        )
+
+class CatalogChangeFeed:
+    # In-process pub/sub of product changes. Subscribers register a
+    # callback for some product ids; the ids changed during a tick are
+    # delivered on the event loop in one call per callback, however many
+    # updates there were. An optional backend (see SQLiteCatalogUpdates)
+    # carries the updates to the other processes.
+    def __init__(self, tick: float = CATALOG_UPDATE_TICK_SECONDS, backend: "SQLiteCatalogUpdates" = None):
+        self.tick = tick
+        self.backend = backend
+        self._listeners: Dict[int, Set[Callable[[List[int]], None]]] = {}
+        self._pending: Set[int] = set()
+        self._pending_bulk: List[np.ndarray] = []
+        self._scheduled = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+    
+    def subscribe(self, product_ids: Iterable[int], callback: Callable[[List[int]], None]) -> Callable[[], None]:
+        # Returns the function that unsubscribes the callback
+        product_ids = list(product_ids)
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        with self._lock:
+            for product_id in product_ids:
+                self._listeners.setdefault(product_id, set()).add(callback)
+        
+        def unsubscribe():
+            with self._lock:
+                for product_id in product_ids:
+                    listeners = self._listeners.get(product_id)
+                    if listeners is not None:
+                        listeners.discard(callback)
+                        if not listeners:
+                            del self._listeners[product_id]
+        
+        return unsubscribe
+    
+    def publish(self, updates: List[ProductUpdate]):
+        # Safe to call from any thread
+        with self._lock:
+            self._pending.update(update.product_id for update in updates)
+        self._schedule()
+    
+    def publish_bulk(self, bulk: BulkUpdate):
+        # The changed ids are only matched against the watched ones at flush
+        with self._lock:
+            self._pending_bulk.append(bulk.product_ids)
+        self._schedule()
+    
+    def _schedule(self):
+        with self._lock:
+            schedule = not self._scheduled
+            self._scheduled = True
+        if not schedule:
+            return
+        if self._loop is None:
+            self.flush()
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._loop.call_later, self.tick, self.flush)
+        except RuntimeError:
+            # The loop was closed; there is nobody left to notify
+            self._loop = None
+            self.flush()
+    
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, set()
+            bulk, self._pending_bulk = self._pending_bulk, []
+            self._scheduled = False
+            if bulk and self._listeners:
+                watched = np.fromiter(self._listeners, np.int64, len(self._listeners))
+                for product_ids in bulk:
+                    pending.update(watched[np.isin(watched, product_ids)].tolist())
+            # Walk whichever side is smaller: the changed ids or the watched ones
+            if len(pending) > len(self._listeners):
+                changed = [product_id for product_id in self._listeners if product_id in pending]
+            else:
+                changed = [product_id for product_id in pending if product_id in self._listeners]
+            calls: Dict[Callable[[List[int]], None], List[int]] = {}
+            for product_id in changed:
+                for callback in self._listeners[product_id]:
+                    calls.setdefault(callback, []).append(product_id)
+        for callback, product_ids in calls.items():
+            callback(product_ids)
+
+# How long items added to a cart hold their stock before being released
+RESERVATION_TTL_SECONDS = 15 * 60
+
+class OutOfStockError(Exception):
+    def __init__(self, product_id: int):
+        super().__init__(f"Not enough stock for product {product_id}")
+        self.product_id = product_id
+
+class ProductUnavailableError(Exception):
+    # The product is no longer in the catalog, e.g. after a reload
+    def __init__(self, product_id: int):
+        super().__init__(f"Product {product_id} is no longer in the catalog")
+        self.product_id = product_id
+
+@dataclass
+class Reservation:
+    quantity: int
+    expires_at: float
+
+class InventoryService:
+    # Holds short-lived stock reservations per cart and commits checkouts
+    # atomically. Every SKU has its own lock; a checkout takes the locks of
+    # its SKUs in id order, so concurrent checkouts never deadlock.
+    def __init__(self, catalog: ProductCatalog, reservation_ttl: float = RESERVATION_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.catalog = catalog
+        self.reservation_ttl = reservation_ttl
+        self.clock = clock
+        self._locks: Dict[int, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        self._reserved: Dict[int, int] = {}
+        self._holds: Dict[str, Dict[int, Reservation]] = {}
+        self._expiry_heap: List[Tuple[float, str, int]] = []
+        self._expiry_guard = threading.Lock()
+    
+    def _lock(self, product_id: int) -> threading.Lock:
+        lock = self._locks.get(product_id)
+        if lock is None:
+            with self._locks_guard:
+                lock = self._locks.setdefault(product_id, threading.Lock())
+        return lock
+    
+    def _product(self, product_id: int) -> Product:
+        product = self.catalog.get(product_id)
+        if product is None:
+            raise ProductUnavailableError(product_id)
+        return product
+    
+    def _release_locked(self, cart_id: str, product_id: int, quantity: int):
+        holds = self._holds.get(cart_id, {})
+        hold = holds.get(product_id)
+        if hold is None:
+            return
+        quantity = min(quantity, hold.quantity)
+        hold.quantity -= quantity
+        self._reserved[product_id] -= quantity
+        if hold.quantity == 0:
+            del holds[product_id]
+    
+    def available(self, product_id: int) -> int:
+        return self._product(product_id).stock - self._reserved.get(product_id, 0)
+    
+    def reserved_by(self, cart_id: str, product_id: int) -> int:
+        hold = self._holds.get(cart_id, {}).get(product_id)
+        return hold.quantity if hold else 0
+    
+    def reserve(self, cart_id: str, product_id: int, quantity: int = 1) -> bool:
+        self.expire_reservations()
+        with self._lock(product_id):
+            if self.available(product_id) < quantity:
+                return False
+            expires_at = self.clock() + self.reservation_ttl
+            holds = self._holds.setdefault(cart_id, {})
+            hold = holds.setdefault(product_id, Reservation(0, expires_at))
+            hold.quantity += quantity
+            hold.expires_at = expires_at
+            self._reserved[product_id] = self._reserved.get(product_id, 0) + quantity
+        with self._expiry_guard:
+            heapq.heappush(self._expiry_heap, (expires_at, cart_id, product_id))
+        return True
+    
+    def release(self, cart_id: str, product_id: int, quantity: Optional[int] = None):
+        with self._lock(product_id):
+            self._release_locked(cart_id, product_id, quantity if quantity is not None else self.reserved_by(cart_id, product_id))
+    
+    def set_quantity(self, cart_id: str, product_id: int, quantity: int) -> bool:
+        delta = quantity - self.reserved_by(cart_id, product_id)
+        if delta > 0:
+            return self.reserve(cart_id, product_id, delta)
+        if delta < 0:
+            self.release(cart_id, product_id, -delta)
+        return True
+    
+    def release_all(self, cart_id: str):
+        for product_id in list(self._holds.get(cart_id, {})):
+            self.release(cart_id, product_id)
+        self._holds.pop(cart_id, None)
+    
+    def expire_reservations(self):
+        now = self.clock()
+        expired = []
+        with self._expiry_guard:
+            while self._expiry_heap and self._expiry_heap[0][0] <= now:
+                expired.append(heapq.heappop(self._expiry_heap))
+        for expires_at, cart_id, product_id in expired:
+            with self._lock(product_id):
+                hold = self._holds.get(cart_id, {}).get(product_id)
+                # Skip entries superseded by a later reservation of the same item
+                if hold is not None and hold.expires_at <= now:
+                    self._release_locked(cart_id, product_id, hold.quantity)
+    
+    def checkout(self, cart_id: str, items: Dict[int, int]):
+        # Either every item is committed or, on OutOfStockError, none is
+        self.expire_reservations()
+        with ExitStack() as stack:
+            for product_id in sorted(items):
+                stack.enter_context(self._lock(product_id))
+            for product_id, quantity in items.items():
+                extra = quantity - self.reserved_by(cart_id, product_id)
+                if extra > self.available(product_id):
+                    raise OutOfStockError(product_id)
+            # The stock is decremented in the catalog's write lock, not set
+            # from the value read here, so concurrent writes don't undo it
+            self.catalog.adjust_stock({product_id: -quantity for product_id, quantity in items.items()})
+            for product_id, quantity in items.items():
+                self._release_locked(cart_id, product_id, quantity)
+        self.release_all(cart_id)
+
+# Widths, in pixels, of the resized product images; requests for other widths are refused
+IMAGE_WIDTHS = (64, 128, 300, 600, 1200)
+# Disk space used by originals and resized images before the least recently used are deleted
+IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+IMAGE_QUALITY = 80
+
+def fetch_remote_image(url: str) -> bytes:
+    with urlopen(url, timeout=10) as response:
+        return response.read()
+
+class LocalImageFetcher:
+    # Stand-in for the network: serves the file of a directory whose name
+    # (without extension) is the last path segment of the image URL
+    def __init__(self, directory: str):
+        self.files = {path.stem: path for path in Path(directory).iterdir() if path.is_file()}
+    
+    def __call__(self, url: str) -> bytes:
+        name = Path(urlparse(url).path).stem
+        if name not in self.files:
+            raise FileNotFoundError(url)
+        return self.files[name].read_bytes()
+
+class ImageService:
+    # Downloads each product image once and serves WebP copies resized to
+    # IMAGE_WIDTHS from a disk cache bounded by `max_bytes` (LRU eviction).
+    # Resizing needs Pillow, which is imported on first use.
+    def __init__(self, cache_dir: str, max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+                 fetch: Callable[[str], bytes] = fetch_remote_image):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.fetch = fetch
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        # Files already on disk, least recently used first
+        self._entries: "OrderedDict[Path, int]" = OrderedDict()
+        self._total_bytes = 0
+        for path in sorted(self.cache_dir.iterdir(), key=lambda path: path.stat().st_atime):
+            if path.suffix == ".tmp":
+                path.unlink()
+            elif path.is_file():
+                self._track(path, path.stat().st_size)
+    
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+    
+    def _track(self, path: Path, size: int):
+        previous = self._entries.pop(path, None)
+        if previous is not None:
+            self._total_bytes -= previous
+        self._entries[path] = size
+        self._total_bytes += size
+    
+    def _touch(self, path: Path) -> bool:
+        with self._lock:
+            if path in self._entries and path.exists():
+                self._entries.move_to_end(path)
+                return True
+            return False
+    
+    def _store(self, path: Path, data: bytes):
+        # Written under a temporary name so readers never see partial files
+        temporary = path.with_name(f"{path.name}.{uuid4().hex}.tmp")
+        temporary.write_bytes(data)
+        os.replace(temporary, path)
+        with self._lock:
+            self._track(path, len(data))
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                oldest, size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+                oldest.unlink(missing_ok=True)
+    
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+    
+    def original(self, url: str) -> Path:
+        path = self.cache_dir / f"{self.key(url)}.orig"
+        if not self._touch(path):
+            self._store(path, self.fetch(url))
+        return path
+    
+    def variant(self, url: str, width: int) -> Path:
+        # Concurrent requests for the same image resize it only once
+        if width not in IMAGE_WIDTHS:
+            raise ValueError(f"Unsupported image width {width}")
+        key = self.key(url)
+        path = self.cache_dir / f"{key}-{width}.webp"
+        if self._touch(path):
+            return path
+        with self._key_lock(key):
+            if self._touch(path):
+                return path
+            from PIL import Image
+            with Image.open(self.original(url)) as image:
+                image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+                if image.width > width:
+                    image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+                output = io.BytesIO()
+                image.save(output, "WEBP", quality=IMAGE_QUALITY, method=4)
+            self._store(path, output.getvalue())
+        return path
+
+# "Compre junto": neighbors kept per product, and how often two products
+# must have shared a cart before they are recommended together
+RECOMMENDATIONS_PER_PRODUCT = 8
+RECOMMENDATION_MIN_COUNT = 2
+# How often the background job folds new cart events into the neighbors
+RECOMMENDATIONS_REFRESH_SECONDS = 60
+# Carts whose contents are remembered to pair them with later additions
+RECOMMENDATION_OPEN_CARTS = 100_000
+
+def count_keys(keys: np.ndarray, counts: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    # Sorted distinct keys and how often each occurs (or the sum of its
+    # `counts`)
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return unique, np.bincount(inverse, weights=counts, minlength=len(unique)).astype(np.int64)
+
+def merge_counts(keys: np.ndarray, counts: np.ndarray,
+                 new_keys: np.ndarray, new_counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    return count_keys(np.concatenate([keys, new_keys]), np.concatenate([counts, new_counts]))
+
+class CoOccurrenceRecommender:
+    # "Frequently bought together" from cart events. Recording an event
+    # only appends it to a list; process_events() folds the pending events
+    # into a sparse co-occurrence matrix, kept as sorted NumPy arrays of
+    # pair keys (a << 32 | b) and their counts, and compute_neighbors()
+    # precomputes the top products of every row, so a page reads its
+    # recommendations with one dict lookup.
+    def __init__(self, k: int = RECOMMENDATIONS_PER_PRODUCT, min_count: int = RECOMMENDATION_MIN_COUNT):
+        self.k = k
+        self.min_count = min_count
+        self.pair_keys = np.zeros(0, np.int64)
+        self.pair_counts = np.zeros(0, np.int64)
+        self.item_ids = np.zeros(0, np.int64)
+        self.item_counts = np.zeros(0, np.int64)
+        self.neighbors: Dict[int, Tuple[int, ...]] = {}
+        self._events: List[Tuple[str, str, Sequence[int]]] = []
+        self._carts: "OrderedDict[str, Set[int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+    
+    def record_add(self, cart_id: str, product_id: int):
+        self._events.append(("add", cart_id, (product_id,)))
+    
+    def record_checkout(self, cart_id: str, product_ids: Iterable[int]):
+        # A purchase counts its pairs once more on top of the cart additions
+        self._events.append(("checkout", cart_id, tuple(product_ids)))
+    
+    def process_events(self) -> int:
+        # Returns the number of events folded in. The events are flattened
+        # into groups of products (see _fold); the pairs of all the groups
+        # are then built and counted over arrays, without a per-pair loop.
+        with self._lock:
+            events, self._events = self._events, []
+            added: Dict[str, List[int]] = {}
+            # Members of each group, earlier ones first, and the number of
+            # earlier and new members of each group, alternately
+            members: List[int] = []
+            runs: List[int] = []
+            items: List[int] = []
+            for kind, cart_id, product_ids in events:
+                if kind == "add":
+                    added.setdefault(cart_id, []).extend(product_ids)
+                else:
+                    self._fold(cart_id, added.pop(cart_id, []), members, runs, items)
+                    purchase = set(product_ids)
+                    members.extend(purchase)
+                    runs += (0, len(purchase))
+                    self._carts.pop(cart_id, None)
+            for cart_id, product_ids in added.items():
+                self._fold(cart_id, product_ids, members, runs, items)
+            if items:
+                self.item_ids, self.item_counts = merge_counts(
+                    self.item_ids, self.item_counts, *count_keys(np.array(items, np.int64))
+                )
+            pair_keys = self._pair_keys(np.array(members, np.int64), np.array(runs, np.int64))
+            if len(pair_keys):
+                self.pair_keys, self.pair_counts = merge_counts(
+                    self.pair_keys, self.pair_counts, *count_keys(pair_keys)
+                )
+            while len(self._carts) > RECOMMENDATION_OPEN_CARTS:
+                self._carts.popitem(last=False)
+        return len(events)
+    
+    def _fold(self, cart_id: str, product_ids: List[int], members: List[int], runs: List[int], items: List[int]):
+        # Adds the cart as one group: its earlier products, then the ones
+        # new to it, which are paired with every other product of the group
+        cart = self._carts.pop(cart_id, None) or set()
+        new = [product_id for product_id in dict.fromkeys(product_ids) if product_id not in cart]
+        if new:
+            items += new
+            members += cart
+            members += new
+            runs += (len(cart), len(new))
+            cart.update(new)
+        self._carts[cart_id] = cart
+    
+    @staticmethod
+    def _pair_keys(members: np.ndarray, runs: np.ndarray) -> np.ndarray:
+        # Keys of the ordered pairs of distinct members of each group with
+        # at least one new member. Every member is repeated once per member
+        # of its group (left) and matched with each of them in turn (right).
+        is_new = np.repeat(np.arange(len(runs)) % 2 == 1, runs)
+        sizes = runs[0::2] + runs[1::2]
+        starts = np.cumsum(sizes) - sizes
+        group_sizes = np.repeat(sizes, sizes)
+        left = np.repeat(np.arange(len(members)), group_sizes)
+        block_starts = np.repeat(np.cumsum(group_sizes) - group_sizes, group_sizes)
+        right = np.repeat(np.repeat(starts, sizes), group_sizes) + np.arange(len(left)) - block_starts
+        keep = (left != right) & (is_new[left] | is_new[right])
+        return members[left[keep]] << 32 | members[right[keep]]
+    
+    def compute_neighbors(self):
+        # Scores pairs by count / sqrt(count of each product) so that
+        # best sellers do not top every row, then swaps the table in
+        with self._lock:
+            keys, counts = self.pair_keys, self.pair_counts
+            item_ids, item_counts = self.item_ids, self.item_counts
+        frequent = counts >= self.min_count
+        keys, counts = keys[frequent], counts[frequent]
+        a, b = keys >> 32, keys & 0xFFFFFFFF
+        weights = self._lookup(item_ids, item_counts, a) * self._lookup(item_ids, item_counts, b)
+        scores = counts / np.sqrt(np.where(weights > 0, weights, 1))
+        # Rows by product, each by descending score, ties by descending id
+        order = np.lexsort((-b, -scores, a))
+        a, b = a[order], b[order]
+        rows, starts = np.unique(a, return_index=True)
+        ends = np.append(starts[1:], len(a))
+        ends = np.minimum(ends, starts + self.k)
+        b = b.tolist()
+        self.neighbors = {
+            row: tuple(b[start:end]) for row, start, end in zip(rows.tolist(), starts.tolist(), ends.tolist())
+        }
+    
+    @staticmethod
+    def _lookup(keys: np.ndarray, values: np.ndarray, wanted: np.ndarray) -> np.ndarray:
+        # values[keys == wanted] for each wanted key, 0 for missing keys
+        if not len(keys):
+            return np.zeros(len(wanted), np.int64)
+        positions = np.searchsorted(keys, wanted).clip(max=len(keys) - 1)
+        return np.where(keys[positions] == wanted, values[positions], 0)
+    
+    def refresh(self):
+        if self.process_events():
+            self.compute_neighbors()
+    
+    def get(self, product_id: int) -> Tuple[int, ...]:
+        return self.neighbors.get(product_id, ())
+    
+    def start(self, interval: float = RECOMMENDATIONS_REFRESH_SECONDS) -> threading.Thread:
+        def run():
+            while not self._stopped.wait(interval):
+                self.refresh()
+        
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+    
+    def stop(self):
+        self._stopped.set()
+
+# ========== INSTRUMENTATION ==========
+
+# Opt-in: when disabled, the decorators below return the undecorated
+# function or class, so there is no per-call overhead at all
+INSTRUMENTATION_ENABLED = os.environ.get("INSTRUMENTATION") == "1"
+
+def count_vdom_nodes(node) -> int:
+    if isinstance(node, dict):
+        return 1 + sum(count_vdom_nodes(child) for child in node.get("children", ()))
+    return 0
+
+class Metrics:
+    # Call counts, wall time and rendered VDOM nodes per instrumented name
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, float]] = {}
+    
+    def record(self, name: str, seconds: float, nodes: int = 0):
+        with self._lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "vdom_nodes": 0}
+            stat["calls"] += 1
+            stat["seconds"] += seconds
+            stat["max_seconds"] = max(stat["max_seconds"], seconds)
+            stat["vdom_nodes"] += nodes
+    
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+    
+    def to_json(self) -> str:
+        with self._lock:
+            return json.dumps(self.stats, indent=2, sort_keys=True)
+    
+    def to_prometheus(self) -> str:
+        series = [
+            ("loja_calls_total", "counter", "calls"),
+            ("loja_duration_seconds_total", "counter", "seconds"),
+            ("loja_duration_seconds_max", "gauge", "max_seconds"),
+            ("loja_vdom_nodes_total", "counter", "vdom_nodes"),
+        ]
+        lines = []
+        with self._lock:
+            for metric, kind, field in series:
+                lines.append(f"# TYPE {metric} {kind}")
+                for name, stat in sorted(self.stats.items()):
+                    lines.append(f'{metric}{{name="{name}"}} {stat[field]}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def instrumented(name: str, count_nodes: bool = False):
+    # Records each call of the decorated function (sync or async) under `name`;
+    # with `count_nodes`, also the size of the VDOM it returns
+    def decorate(function):
+        if not INSTRUMENTATION_ENABLED:
+            return function
+        
+        if asyncio.iscoroutinefunction(function):
+            @wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    metrics.record(name, time.perf_counter() - start)
+            return async_wrapper
+        
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = None
+            try:
+                result = function(*args, **kwargs)
+                return result
+            finally:
+                elapsed = time.perf_counter() - start
+                metrics.record(name, elapsed, count_vdom_nodes(result) if count_nodes else 0)
+        return wrapper
+    
+    return decorate
+
+def instrumented_methods(cls):
+    # Instruments every public method of a controller class
+    if not INSTRUMENTATION_ENABLED:
+        return cls
+    for attribute, value in list(vars(cls).items()):
+        if inspect.isfunction(value) and not attribute.startswith("_"):
+            setattr(cls, attribute, instrumented(f"{cls.__name__}.{attribute}")(value))
+    return cls
+
+class SamplingProfiler:
+    # Samples the stack of one thread at a fixed interval and aggregates the
+    # samples as collapsed stacks ("a;b;c count"), the flame graph input format
+    def __init__(self, thread_id: int = None, interval: float = 0.005):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.samples: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({Path(frame.f_code.co_filename).name}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+    
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+    
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.samples.items()))
+
+# ========== CONTROLLERS ==========
+
+# Time to wait for typing to pause before a search runs
+SEARCH_DEBOUNCE_SECONDS = 0.15
+# Catalog size from which searches run off the event loop thread
+SEARCH_OFFLOAD_THRESHOLD = 10_000
+# Number of product cards rendered per page of the product grid
+PRODUCTS_PAGE_SIZE = 24
+
+@instrumented_methods
+class ProductController:
+    def __init__(self, catalog: ProductCatalog = None):
+        self.catalog = catalog if catalog is not None else ProductCatalog()
+        self.selection = FacetSelection()
+        self._filtered_products: Sequence[Product] = self.catalog.products
+        self._facet_counts: Dict[str, Dict] = {}
+        self._generation = self.catalog.generation
+        self.apply_filters()
+    
+    @property
+    def products(self) -> List[Product]:
+        return self.catalog.products
+    
+    @property
+    def filtered_products(self) -> Sequence[Product]:
+        # A selection made before the catalog swapped its indexes (bulk
+        # update, reload) is recomputed on first read
+        if self._generation != self.catalog.generation:
+            self.apply_filters()
+        return self._filtered_products
+    
+    @property
+    def facet_counts(self) -> Dict[str, Dict]:
+        if self._generation != self.catalog.generation:
+            self.apply_filters()
+        return self._facet_counts
+    
+    @property
+    def current_category(self) -> str:
+        return self.selection.category
     
     def load_products(self, products: List[Product]):
-        self.products = products
-        self.filtered_products = products
+        self.catalog.load_products(products)
+        self.apply_filters()
+    
+    def apply_filters(self, **changes):
+        # Updates the selected facets/query (see FacetSelection) and recomputes
+        # the filtered products and facet counts
+        self.selection = replace(self.selection, **changes)
+        self._generation = self.catalog.generation
+        self._filtered_products, self._facet_counts = self.catalog.select(self.selection)
     
     def filter_by_category(self, category: str):
-        self.current_category = category
-        if category == "all":
-            self.filtered_products = self.products
-        else:
-            self.filtered_products = [
-                p for p in self.products if p.category.lower() == category.lower()
+        self.apply_filters(category=category)
+    
+    def sort_products(self, sort: str):
+        # One of SORT_OPTIONS; applies to search results and facets alike
+        if sort not in SORT_OPTIONS:
+            raise ValueError(f"Unknown sort option {sort!r}")
+        self.apply_filters(sort=sort)
+    
+    def search_products(self, query: str, mode: str = "index"):
+        # "scan" keeps the original substring scan as a reference for the index
+        if mode == "scan":
+            query = query.lower()
+            self._filtered_products = [
+                p for p in self.products 
+                if query in p.name.lower() or query in p.description.lower()
             ]
+        else:
+            self.apply_filters(query=query)
     
-    def search_products(self, query: str):
-        query = query.lower()
-        self.filtered_products = [
-            p for p in self.products 
-            if query in p.name.lower() or query in p.description.lower()
-        ]
+    async def search_products_async(self, query: str):
+        # Large catalogs are searched on the loop's thread pool so the event
+        # loop keeps serving other connections. If the awaiting task is
+        # cancelled by a newer query, the stale result is never committed.
+        selection = replace(self.selection, query=query)
+        generation = self.catalog.generation
+        if len(self.products) < SEARCH_OFFLOAD_THRESHOLD:
+            results = self.catalog.select(selection)
+        else:
+            loop = asyncio.get_running_loop()
+            results = await loop.run_in_executor(None, self.catalog.select, selection)
+            # Facets clicked or catalog swapped meanwhile: keep the clicks and
+            # select again with the query on top of them
+            if selection != replace(self.selection, query=query) or generation != self.catalog.generation:
+                self.apply_filters(query=query)
+                return
+        self.selection = selection
+        self._generation = generation
+        self._filtered_products, self._facet_counts = results
+    
+    def get_featured_products(self) -> List[Product]:
+        return self.catalog.featured.get()
+    
+    def get_bought_together(self, product_id: int, recommender: CoOccurrenceRecommender,
+                            limit: int = 4) -> List[Product]:
+        # Precomputed neighbors of the product that are still in stock
+        products = [self.catalog.get(other) for other in recommender.get(product_id)]
+        return [product for product in products if product is not None and product.stock > 0][:limit]
+    
+    def get_page(self, cursor: int = 0, limit: int = PRODUCTS_PAGE_SIZE) -> Tuple[List[Product], Optional[int]]:
+        # Returns the products after `cursor` and the cursor of the next page,
+        # or None when the filtered list is exhausted
+        end = cursor + limit
+        next_cursor = end if end < len(self.filtered_products) else None
+        return self.filtered_products[cursor:end], next_cursor
     
     def get_product_by_id(self, product_id: int) -> Product:
-        for product in self.products:
-            if product.id == product_id:
-                return product
-        return None
+        return self.catalog.get(product_id)
+
+# Operations recorded in a cart log between two compacted snapshots
+CART_COMPACT_EVERY = 50
 
+@instrumented_methods
 class CartController:
-    def __init__(self):
+    # Every change is an operation ("add", "remove", "update" or "clear")
+    # applied to the cart and, with a `log`, appended to it under the next
+    # cart version. Another replica of the same session (a reconnecting
+    # client, another worker) catches up by replaying only the operations
+    # after its own version.
+    def __init__(self, on_change: Callable[[], None] = None, inventory: InventoryService = None,
+                 log: CartLog = None, session_id: str = None, catalog: ProductCatalog = None,
+                 recommender: CoOccurrenceRecommender = None):
         self.cart = ShoppingCart()
+        # Stock is reserved per session, shared by its tabs and replicas
+        self.cart_id = session_id or uuid4().hex
+        self.on_change = on_change
+        self.inventory = inventory
+        self.recommender = recommender
+        self.log = log
+        self.session_id = session_id
+        self.catalog = catalog
+        self.version = 0
+        self._snapshot_version = 0
+    
+    def _notify(self):
+        if self.on_change:
+            self.on_change()
+    
+    def _apply(self, op: List, product: Product = None) -> bool:
+        kind, args = op[0], op[1:]
+        if kind == "add":
+            product_id, quantity = args
+            product = product or self.catalog.get(product_id)
+            if product is None:
+                return False
+            # Reservations follow the cart's quantities, so a replica
+            # replaying this operation doesn't reserve the stock again
+            held = self.cart.items[product_id].quantity if product_id in self.cart.items else 0
+            if self.inventory and not self.inventory.set_quantity(self.cart_id, product_id, held + quantity):
+                return False
+            self.cart.add_item(product, quantity)
+        elif kind == "remove":
+            self.cart.remove_item(args[0])
+            if self.inventory:
+                self.inventory.release(self.cart_id, args[0])
+        elif kind == "update":
+            product_id, quantity = args
+            if self.inventory and product_id in self.cart.items:
+                if not self.inventory.set_quantity(self.cart_id, product_id, max(quantity, 0)):
+                    return False
+            self.cart.update_quantity(product_id, quantity)
+        elif kind == "clear":
+            self.cart.clear()
+            if self.inventory:
+                self.inventory.release_all(self.cart_id)
+        return True
+    
+    def _execute(self, op: List, product: Product = None) -> bool:
+        if self.log is None:
+            if not self._apply(op, product):
+                return False
+            self.version += 1
+            self._notify()
+            return True
+        self.sync(notify=False)
+        while True:
+            if not self._apply(op, product):
+                return False
+            if self.log.append(self.session_id, self.version + 1, op):
+                break
+            # Another replica wrote this version first: rebuild from the log
+            # and apply the operation on top of it
+            self.reload()
+        self.version += 1
+        if self.version - self._snapshot_version >= CART_COMPACT_EVERY:
+            self.compact()
+        self._notify()
+        return True
     
-    def add_to_cart(self, product: Product, quantity: int = 1):
-        self.cart.add_item(product, quantity)
+    def _replay(self, ops: Iterable[Tuple[int, List]]):
+        # Operations refused here (stock ran out, product removed) were
+        # already accepted by the replica that logged them; they are skipped
+        for version, op in ops:
+            self._apply(op)
+            self.version = version
+    
+    def load(self):
+        version, items, ops = self.log.load(self.session_id)
+        self.restore(items, self.catalog)
+        self.version = self._snapshot_version = version
+        self._replay(ops)
+    
+    def reload(self):
+        self.cart.clear()
+        if self.inventory:
+            self.inventory.release_all(self.cart_id)
+        self.load()
+    
+    def sync(self, notify: bool = True) -> int:
+        # Applies the operations logged by other replicas since this one's
+        # version and returns how many there were
+        if self.log is None:
+            return 0
+        ops = self.log.ops_since(self.session_id, self.version)
+        if ops is None:
+            self.reload()
+            changed = 1
+        else:
+            self._replay(ops)
+            changed = len(ops)
+        if changed and notify:
+            self._notify()
+        return changed
+    
+    def compact(self):
+        if self.log is not None and self.version > self._snapshot_version:
+            self.log.compact(self.session_id, self.version, self.snapshot())
+            self._snapshot_version = self.version
+    
+    def add_to_cart(self, product: Product, quantity: int = 1) -> bool:
+        added = self._execute(["add", product.id, quantity], product)
+        if added and self.recommender:
+            self.recommender.record_add(self.cart_id, product.id)
+        return added
     
     def remove_from_cart(self, product_id: int):
-        self.cart.remove_item(product_id)
+        self._execute(["remove", product_id])
+    
+    def update_cart_quantity(self, product_id: int, quantity: int) -> bool:
+        return self._execute(["update", product_id, quantity])
     
-    def update_cart_quantity(self, product_id: int, quantity: int):
-        self.cart.update_quantity(product_id, quantity)
+    def reprice(self, product_ids: Iterable[int]):
+        for product_id in product_ids:
+            self.cart.reprice(product_id)
     
-    def get_cart_total(self) -> float:
+    def get_cart_total(self) -> Decimal:
         return self.cart.get_total()
     
     def get_cart_items_count(self) -> int:
         return self.cart.get_items_count()
     
     def clear_cart(self):
-        self.cart.clear()
+        self._execute(["clear"])
+    
+    def snapshot(self) -> Dict[str, int]:
+        return {str(product_id): item.quantity for product_id, item in self.cart.items.items()}
+    
+    def restore(self, snapshot: Dict[str, int], catalog: ProductCatalog):
+        # Products that left the catalog are dropped; stock is re-reserved
+        # where still available and re-checked at checkout either way
+        for product_id, quantity in snapshot.items():
+            product = catalog.get(int(product_id))
+            if product is None:
+                continue
+            if self.inventory:
+                held = self.cart.items[product.id].quantity if product.id in self.cart.items else 0
+                self.inventory.set_quantity(self.cart_id, product.id, held + quantity)
+            self.cart.add_item(product, quantity)
+    
+    def checkout(self) -> Decimal:
+        # Raises OutOfStockError or ProductUnavailableError and keeps the cart
+        # when any item is unavailable
+        self.sync(notify=False)
+        items = {product_id: item.quantity for product_id, item in self.cart.items.items()}
+        if self.inventory:
+            self.inventory.checkout(self.cart_id, items)
+        if self.recommender:
+            self.recommender.record_checkout(self.cart_id, items)
+        total = self.cart.get_total()
+        self._execute(["clear"])
+        return total
 
 # ========== SAMPLE DATA ==========
 
@@ -226,43 +2644,132 @@ def get_sample_user():
 
 # ========== VIEW COMPONENTS ==========
 
+# Generated by build_css.py: short class names for the Tailwind class
+# strings of the components and the stylesheet that defines them
+STATIC_DIR = Path(__file__).parent / "static"
+CLASS_NAMES_FILE = STATIC_DIR / "class_names.json"
+STYLESHEET_FILE = STATIC_DIR / "styles.css"
+
+def load_class_names(path: Path = CLASS_NAMES_FILE) -> Dict[str, str]:
+    if not path.exists():
+        return {}
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+CLASS_NAMES = load_class_names()
+
+def tw(*parts: str) -> str:
+    # "class" attribute for Tailwind class strings. Strings compiled by
+    # build_css.py become one short name each; others pass through as is.
+    return " ".join(CLASS_NAMES.get(part, part) for part in parts if part)
+
+@dataclass(frozen=True)
+class ProductDisplay:
+    # Formatted product fields, computed once per product version
+    version: int
+    short_description: str
+    price_label: str
+    stock_label: str
+    filled_stars: str
+    empty_stars: str
+    rating_label: str
+    
+    @classmethod
+    def from_product(cls, product: Product) -> "ProductDisplay":
+        description = product.description
+        return cls(
+            version=product.version,
+            short_description=description[:80] + "..." if len(description) > 80 else description,
+            price_label=f"R$ {product.price:.2f}",
+            stock_label=f"Estoque: {product.stock}",
+            filled_stars="★" * int(product.rating),
+            empty_stars="★" * (5 - int(product.rating)),
+            rating_label=f"({product.rating})"
+        )
+
+# Displays of the products of one catalog load: a new load may reuse ids
+# and versions for different data, so the cache starts over with it
+_product_displays: Dict[int, ProductDisplay] = {}
+_product_displays_source: Sequence[Product] = ()
+
+def get_product_display(product: Product) -> ProductDisplay:
+    global _product_displays, _product_displays_source
+    if _product_displays_source is not product_catalog.products:
+        _product_displays, _product_displays_source = {}, product_catalog.products
+    display = _product_displays.get(product.id)
+    if display is None or display.version != product.version:
+        display = _product_displays[product.id] = ProductDisplay.from_product(product)
+    return display
+
+def use_product_updates(product_ids: Iterable[int], on_update: Callable[[List[int]], None] = None):
+    # Re-renders the calling component, and only it, when any of the
+    # products changes in the catalog (see CatalogChangeFeed)
+    _, set_version = hooks.use_state(0)
+    product_ids = list(product_ids)
+    
+    def handle_update(changed: List[int]):
+        if on_update is not None:
+            on_update(changed)
+        set_version(lambda version: version + 1)
+    
+    @hooks.use_effect(dependencies=[",".join(map(str, product_ids))])
+    def subscribe():
+        return product_catalog.changes.subscribe(product_ids, handle_update)
+
+def product_image(product: Product, css_class: str, width: int, sizes: str, lazy: bool = True) -> Dict:
+    # <img> attributes for a product photo. With the image service enabled
+    # the browser picks the smallest resized copy that fits `sizes`, and
+    # `width` is the copy used by browsers without srcset support.
+    attributes = {"src": product.image_url, "alt": product.name, "class": css_class, "decoding": "async"}
+    if lazy:
+        attributes["loading"] = "lazy"
+    if image_service is not None:
+        # The URL hash changes with the image, so cached copies never go stale
+        version = ImageService.key(product.image_url)[:8]
+        base = f"{IMAGE_ROUTE}/{product.id}"
+        attributes["src"] = f"{base}/{width}.webp?v={version}"
+        attributes["srcSet"] = ", ".join(f"{base}/{w}.webp?v={version} {w}w" for w in IMAGE_WIDTHS)
+        attributes["sizes"] = sizes
+    return attributes
+
 @component
+@instrumented("component.Header", count_nodes=True)
 def Header(cart_controller, user_session, set_show_cart, set_current_page):
     cart_items_count = cart_controller.get_cart_items_count()
     
     return html.header(
         {
-            "class": "bg-blue-600 text-white p-4 shadow-md sticky top-0 z-10"
+            "class": tw("bg-blue-600 text-white p-4 shadow-md sticky top-0 z-10")
         },
         html.div(
             {
-                "class": "container mx-auto flex justify-between items-center"
+                "class": tw("container mx-auto flex justify-between items-center")
             },
             html.div(
                 {
-                    "class": "flex items-center space-x-4"
+                    "class": tw("flex items-center space-x-4")
                 },
                 html.h1(
                     {
-                        "class": "text-2xl font-bold cursor-pointer",
+                        "class": tw("text-2xl font-bold cursor-pointer"),
                         "on_click": lambda event: set_current_page("home")
                     },
                     "🛒 E-Store"
                 ),
                 html.nav(
                     {
-                        "class": "hidden md:flex space-x-4"
+                        "class": tw("hidden md:flex space-x-4")
                     },
                     html.a(
                         {
-                            "class": "hover:text-blue-200 cursor-pointer",
+                            "class": tw("hover:text-blue-200 cursor-pointer"),
                             "on_click": lambda event: set_current_page("home")
                         },
                         "Home"
                     ),
                     html.a(
                         {
-                            "class": "hover:text-blue-200 cursor-pointer",
+                            "class": tw("hover:text-blue-200 cursor-pointer"),
                             "on_click": lambda event: set_current_page("products")
                         },
                         "Produtos"
@@ -271,32 +2778,32 @@ def Header(cart_controller, user_session, set_show_cart, set_current_page):
             ),
             html.div(
                 {
-                    "class": "flex items-center space-x-4"
+                    "class": tw("flex items-center space-x-4")
                 },
                 html.div(
                     {
-                        "class": "relative cursor-pointer",
+                        "class": tw("relative cursor-pointer"),
                         "on_click": lambda event: set_show_cart(True)
                     },
                     html.span("🛒"),
                     html.span(
                         {
-                            "class": "absolute -top-2 -right-2 bg-red-500 rounded-full w-5 h-5 flex items-center justify-center text-xs"
+                            "class": tw("absolute -top-2 -right-2 bg-red-500 rounded-full w-5 h-5 flex items-center justify-center text-xs")
                         },
                         f"{cart_items_count}"
                     ) if cart_items_count > 0 else ""
                 ),
                 html.div(
                     {
-                        "class": "flex items-center space-x-2"
+                        "class": tw("flex items-center space-x-2")
                     },
                     html.span(
-                        {"class": "hidden md:inline"},
+                        {"class": tw("hidden md:inline")},
                         f"Olá, {user_session.current_user.name.split()[0]}" if user_session.is_logged_in else "Visitante"
                     ),
                     html.span(
                         {
-                            "class": "bg-blue-500 rounded-full w-8 h-8 flex items-center justify-center"
+                            "class": tw("bg-blue-500 rounded-full w-8 h-8 flex items-center justify-center")
                         },
                         "👤"
                     )
@@ -306,111 +2813,142 @@ def Header(cart_controller, user_session, set_show_cart, set_current_page):
     )
 
 @component
+@instrumented("component.ProductCard", count_nodes=True)
 def ProductCard(product, on_add_to_cart):
-    return html.div(
-        {
-            "class": "bg-white rounded-lg shadow-md overflow-hidden hover:shadow-lg transition-shadow flex flex-col h-full"
-        },
-        html.img(
-            {
-                "src": product.image_url,
-                "alt": product.name,
-                "class": "w-full h-48 object-cover"
-            }
-        ),
-        html.div(
+    use_product_updates([product.id])
+    display = get_product_display(product)
+    handle_add_to_cart = hooks.use_callback(
+        lambda event: on_add_to_cart(product), [on_add_to_cart, product.id, product.version]
+    )
+    
+    def build():
+        return html.div(
             {
-                "class": "p-4 flex flex-col flex-grow"
+                "class": tw("bg-white rounded-lg shadow-md overflow-hidden hover:shadow-lg transition-shadow flex flex-col h-full")
             },
-            html.h3(
-                {
-                    "class": "text-lg font-semibold mb-2"
-                },
-                product.name
-            ),
-            html.p(
-                {
-                    "class": "text-gray-600 mb-2 text-sm flex-grow"
-                },
-                product.description[:80] + "..." if len(product.description) > 80 else product.description
+            html.img(
+                product_image(
+                    product, tw("w-full h-48 object-cover"), 300,
+                    sizes="(min-width: 1024px) 25vw, (min-width: 768px) 50vw, 100vw"
+                )
             ),
             html.div(
                 {
-                    "class": "flex justify-between items-center mb-3"
+                    "class": tw("p-4 flex flex-col flex-grow")
                 },
-                html.span(
+                html.h3(
                     {
-                        "class": "text-2xl font-bold text-blue-600"
+                        "class": tw("text-lg font-semibold mb-2")
                     },
-                    f"R$ {product.price:.2f}"
+                    product.name
                 ),
-                html.span(
+                html.p(
                     {
-                        "class": "text-sm text-gray-500"
+                        "class": tw("text-gray-600 mb-2 text-sm flex-grow")
                     },
-                    f"Estoque: {product.stock}"
-                )
-            ),
-            html.div(
-                {
-                    "class": "flex items-center mb-3"
-                },
-                html.span(
+                    display.short_description
+                ),
+                html.div(
                     {
-                        "class": "text-yellow-500 mr-1"
+                        "class": tw("flex justify-between items-center mb-3")
                     },
-                    "★" * int(product.rating)
+                    html.span(
+                        {
+                            "class": tw("text-2xl font-bold text-blue-600")
+                        },
+                        display.price_label
+                    ),
+                    html.span(
+                        {
+                            "class": tw("text-sm text-gray-500")
+                        },
+                        display.stock_label
+                    )
                 ),
-                html.span(
+                html.div(
                     {
-                        "class": "text-gray-400"
+                        "class": tw("flex items-center mb-3")
                     },
-                    "★" * (5 - int(product.rating))
+                    html.span(
+                        {
+                            "class": tw("text-yellow-500 mr-1")
+                        },
+                        display.filled_stars
+                    ),
+                    html.span(
+                        {
+                            "class": tw("text-gray-400")
+                        },
+                        display.empty_stars
+                    ),
+                    html.span(
+                        {
+                            "class": tw("text-sm text-gray-600 ml-2")
+                        },
+                        display.rating_label
+                    )
                 ),
-                html.span(
+                html.button(
                     {
-                        "class": "text-sm text-gray-600 ml-2"
+                        "class": tw("w-full bg-blue-600 text-white py-2 px-4 rounded hover:bg-blue-700 transition-colors"),
+                        "on_click": handle_add_to_cart
                     },
-                    f"({product.rating})"
+                    "Adicionar ao Carrinho"
                 )
-            ),
-            html.button(
-                {
-                    "class": "w-full bg-blue-600 text-white py-2 px-4 rounded hover:bg-blue-700 transition-colors",
-                    "on_click": lambda: on_add_to_cart(product)
-                },
-                "Adicionar ao Carrinho"
             )
         )
-    )
+    
+    # The card subtree is only rebuilt when the product, the catalog load or
+    # the callback changes
+    return hooks.use_memo(build, [product.id, product.version, product_catalog.products, handle_add_to_cart])
 
 @component
+@instrumented("component.CartSidebar", count_nodes=True)
 def CartSidebar(show_cart, set_show_cart, cart_controller):
     cart_items = cart_controller.cart.items.values()
+    use_product_updates(cart_controller.cart.items, on_update=cart_controller.reprice)
+    checkout_message, set_checkout_message = hooks.use_state("")
     
     def handle_remove_item(product_id):
         cart_controller.remove_from_cart(product_id)
     
     def handle_quantity_change(product_id, new_quantity):
-        cart_controller.update_cart_quantity(product_id, new_quantity)
+        if not cart_controller.update_cart_quantity(product_id, new_quantity):
+            set_checkout_message("Estoque insuficiente para aumentar a quantidade.")
+    
+    def handle_checkout(event):
+        try:
+            total = cart_controller.checkout()
+        except OutOfStockError as error:
+            product = cart_controller.cart.items[error.product_id].product
+            set_checkout_message(f"Estoque insuficiente para {product.name}.")
+        except ProductUnavailableError as error:
+            product = cart_controller.cart.items[error.product_id].product
+            cart_controller.remove_from_cart(error.product_id)
+            set_checkout_message(f"{product.name} não está mais disponível e foi removido do carrinho.")
+        else:
+            set_checkout_message(f"Pedido confirmado! Total: R$ {total:.2f}")
     
     return html.div(
         {
-            "class": f"fixed top-0 right-0 h-full w-80 bg-white shadow-lg transform transition-transform z-20 {'translate-x-0' if show_cart else 'translate-x-full'}"
+            "class": tw(
+                "fixed top-0 right-0 h-full w-80 bg-white shadow-lg transform transition-transform z-20",
+                "translate-x-0" if show_cart else "translate-x-full"
+            )
         },
         html.div(
             {
-                "class": "p-4 border-b flex justify-between items-center"
+                "class": tw("p-4 border-b flex justify-between items-center")
             },
             html.h2(
                 {
-                    "class": "text-xl font-semibold"
+                    "class": tw("text-xl font-semibold")
                 },
                 "🛒 Seu Carrinho"
             ),
             html.button(
                 {
-                    "class": "text-gray-500 hover:text-gray-700",
+                    "class": tw("text-gray-500 hover:text-gray-700"),
                     "on_click": lambda event: set_show_cart(False)
                 },
                 "✕"
@@ -418,67 +2956,63 @@ def CartSidebar(show_cart, set_show_cart, cart_controller):
         ),
         html.div(
             {
-                "class": "p-4 overflow-y-auto h-3/4"
+                "class": tw("p-4 overflow-y-auto h-3/4")
             },
             [html.div(
                 {
                     "key": item.product.id,
-                    "class": "border-b py-4"
+                    "class": tw("border-b py-4")
                 },
                 html.div(
                     {
-                        "class": "flex"
+                        "class": tw("flex")
                     },
                     html.img(
-                        {
-                            "src": item.product.image_url,
-                            "alt": item.product.name,
-                            "class": "w-16 h-16 object-cover rounded"
-                        }
+                        product_image(item.product, tw("w-16 h-16 object-cover rounded"), 64, sizes="64px")
                     ),
                     html.div(
                         {
-                            "class": "ml-4 flex-grow"
+                            "class": tw("ml-4 flex-grow")
                         },
                         html.h3(
                             {
-                                "class": "font-semibold"
+                                "class": tw("font-semibold")
                             },
                             item.product.name
                         ),
                         html.p(
                             {
-                                "class": "text-blue-600 font-semibold"
+                                "class": tw("text-blue-600 font-semibold")
                             },
-                            f"R$ {item.product.price:.2f}"
+                            get_product_display(item.product).price_label
                         ),
                         html.div(
                             {
-                                "class": "flex items-center mt-2"
+                                "class": tw("flex items-center mt-2")
                             },
                             html.button(
                                 {
-                                    "class": "bg-gray-200 w-6 h-6 rounded flex items-center justify-center",
-                                    "on_click": lambda event, id=item.product.id: handle_quantity_change(id, item.quantity - 1)
+                                    "class": tw("bg-gray-200 w-6 h-6 rounded flex items-center justify-center"),
+                                    "on_click": lambda event, item=item: handle_quantity_change(item.product.id, item.quantity - 1)
                                 },
                                 "−"
                             ),
                             html.span(
                                 {
-                                    "class": "mx-2"
+                                    "class": tw("mx-2")
                                 },
                                 f"{item.quantity}"
                             ),
                             html.button(
                                 {
-                                    "class": "bg-gray-200 w-6 h-6 rounded flex items-center justify-center",
-                                    "on_click": lambda event, id=item.product.id: handle_quantity_change(id, item.quantity + 1)
+                                    "class": tw("bg-gray-200 w-6 h-6 rounded flex items-center justify-center"),
+                                    "on_click": lambda event, item=item: handle_quantity_change(item.product.id, item.quantity + 1)
                                 },
                                 "+"
                             ),
                             html.button(
                                 {
-                                    "class": "ml-4 text-red-500 hover:text-red-700",
+                                    "class": tw("ml-4 text-red-500 hover:text-red-700"),
                                     "on_click": lambda event, id=item.product.id: handle_remove_item(id)
                                 },
                                 "Remover"
@@ -489,24 +3023,32 @@ def CartSidebar(show_cart, set_show_cart, cart_controller):
             ) for item in cart_items]
         ) if cart_items else html.div(
             {
-                "class": "text-center py-8 text-gray-500"
+                "class": tw("text-center py-8 text-gray-500")
             },
             "Seu carrinho está vazio"
         ),
         html.div(
             {
-                "class": "absolute bottom-0 left-0 right-0 p-4 border-t bg-white"
+                "class": tw("absolute bottom-0 left-0 right-0 p-4 border-t bg-white")
             },
             html.div(
                 {
-                    "class": "flex justify-between text-lg font-semibold mb-4"
+                    "class": tw("flex justify-between text-lg font-semibold mb-4")
                 },
                 html.span("Total:"),
                 html.span(f"R$ {cart_controller.get_cart_total():.2f}")
             ),
+            html.p(
+                {
+                    "class": tw("text-sm text-center text-gray-700 mb-2")
+                },
+                checkout_message
+            ) if checkout_message else "",
             html.button(
                 {
-                    "class": "w-full bg-green-600 text-white py-3 rounded font-semibold hover:bg-green-700"
+                    "class": tw("w-full bg-green-600 text-white py-3 rounded font-semibold hover:bg-green-700 disabled:bg-gray-400"),
+                    "on_click": handle_checkout,
+                    "disabled": not cart_items
                 },
                 "Finalizar Compra"
             )
@@ -514,50 +3056,106 @@ def CartSidebar(show_cart, set_show_cart, cart_controller):
     )
 
 @component
-def HomePage(product_controller, cart_controller):
-    categories = ["all", "eletronicos", "roupas", "calcados", "livros", "acessorios"]
-    search_query, set_search_query = hooks.use_state("")
-    
-    def handle_search(event):
-        set_search_query(event["target"]["value"])
-        if event["target"]["value"]:
-            product_controller.search_products(event["target"]["value"])
-        else:
-            product_controller.filter_by_category("all")
+@instrumented("component.SearchBox", count_nodes=True)
+def SearchBox(on_search, on_clear):
+    # Keystrokes only re-render this input; the product grid is updated once
+    # typing pauses for SEARCH_DEBOUNCE_SECONDS
+    query, set_query = hooks.use_state("")
     
-    def handle_category_change(category):
-        product_controller.filter_by_category(category)
-        set_search_query("")
+    def handle_change(event):
+        set_query(event["target"]["value"])
+        if not event["target"]["value"]:
+            on_clear()
     
-    def handle_add_to_cart(product):
-        cart_controller.add_to_cart(product)
+    @hooks.use_effect(dependencies=[query])
+    async def run_search():
+        # A newer keystroke cancels this task, so only the latest query commits
+        if not query:
+            return
+        await asyncio.sleep(SEARCH_DEBOUNCE_SECONDS)
+        await on_search(query)
+    
+    return html.input(
+        {
+            "type": "text",
+            "placeholder": "Buscar produtos...",
+            "value": query,
+            "on_change": handle_change,
+            "class": tw("w-full p-3 border border-gray-300 rounded-lg mb-4")
+        }
+    )
+
+def facet_button(label, count, active, on_click, key):
+    return html.button(
+        {
+            "key": key,
+            "class": tw("px-4 py-2 rounded-full whitespace-nowrap", "bg-blue-600 text-white" if active else "bg-gray-200 text-gray-700"),
+            "on_click": on_click
+        },
+        f"{label} ({count})"
+    )
+
+@component
+@instrumented("component.HomePage", count_nodes=True)
+def HomePage(product_controller, cart_controller, initial_page=1):
+    categories = ["all", *product_controller.catalog.categories()]
+    selection = product_controller.selection
+    facet_counts = product_controller.facet_counts
+    _, set_results_version = hooks.use_state(0)
+    visible_count, set_visible_count = hooks.use_state(PRODUCTS_PAGE_SIZE * initial_page)
+    
+    def refresh_results():
+        set_results_version(lambda version: version + 1)
+        set_visible_count(PRODUCTS_PAGE_SIZE)
+    
+    async def handle_search(query):
+        await product_controller.search_products_async(query)
+        refresh_results()
+    
+    def handle_clear_search():
+        product_controller.search_products("")
+        refresh_results()
+    
+    def handle_filter_change(**changes):
+        # Search and facets combine: changing one keeps the others
+        product_controller.apply_filters(**changes)
+        refresh_results()
+    
+    def handle_load_more(event):
+        set_visible_count(lambda count: count + PRODUCTS_PAGE_SIZE)
+    
+    # Stable across renders so memoized cards can be reused
+    handle_add_to_cart = hooks.use_callback(
+        lambda product: cart_controller.add_to_cart(product), [cart_controller]
+    )
     
-    featured_products = random.sample(product_controller.products, min(3, len(product_controller.products)))
+    featured_products = product_controller.get_featured_products()
+    visible_products, next_cursor = product_controller.get_page(0, visible_count)
     
     return html.div(
         {
-            "class": "container mx-auto p-4"
+            "class": tw("container mx-auto p-4")
         },
         # Banner
         html.div(
             {
-                "class": "bg-blue-100 rounded-lg p-8 mb-8 text-center"
+                "class": tw("bg-blue-100 rounded-lg p-8 mb-8 text-center")
             },
             html.h2(
                 {
-                    "class": "text-3xl font-bold text-blue-800 mb-4"
+                    "class": tw("text-3xl font-bold text-blue-800 mb-4")
                 },
                 "Bem-vindo à E-Store!"
             ),
             html.p(
                 {
-                    "class": "text-blue-600 mb-6"
+                    "class": tw("text-blue-600 mb-6")
                 },
                 "Encontre os melhores produtos com os melhores preços"
             ),
             html.button(
                 {
-                    "class": "bg-blue-600 text-white px-6 py-3 rounded-lg font-semibold hover:bg-blue-700"
+                    "class": tw("bg-blue-600 text-white px-6 py-3 rounded-lg font-semibold hover:bg-blue-700")
                 },
                 "Ver Ofertas"
             )
@@ -566,186 +3164,442 @@ def HomePage(product_controller, cart_controller):
         # Destaques
         html.h2(
             {
-                "class": "text-2xl font-bold mb-6"
+                "class": tw("text-2xl font-bold mb-6")
             },
             "Produtos em Destaque"
         ),
         html.div(
             {
-                "class": "grid grid-cols-1 md:grid-cols-3 gap-6 mb-12"
+                "class": tw("grid grid-cols-1 md:grid-cols-3 gap-6 mb-12")
             },
-            [ProductCard(product, handle_add_to_cart) for product in featured_products]
+            [ProductCard(product, handle_add_to_cart, key=product.id) for product in featured_products]
         ),
         
         # Todos os produtos
         html.div(
             {
-                "class": "mb-6"
+                "class": tw("mb-6")
             },
             html.h2(
                 {
-                    "class": "text-2xl font-bold mb-4"
+                    "class": tw("text-2xl font-bold mb-4")
                 },
                 "Nossos Produtos"
             ),
-            html.input(
+            SearchBox(handle_search, handle_clear_search),
+            html.div(
                 {
-                    "type": "text",
-                    "placeholder": "Buscar produtos...",
-                    "value": search_query,
-                    "on_change": handle_search,
-                    "class": "w-full p-3 border border-gray-300 rounded-lg mb-4"
-                }
+                    "class": tw("flex space-x-2 overflow-x-auto pb-2")
+                },
+                *[
+                    facet_button(
+                        "Todos" if cat == "all" else cat.capitalize(),
+                        sum(facet_counts["category"].values()) if cat == "all" else facet_counts["category"][cat],
+                        selection.category == cat,
+                        lambda event, cat=cat: handle_filter_change(category=cat),
+                        key=cat
+                    )
+                    for cat in categories
+                ]
             ),
             html.div(
                 {
-                    "class": "flex space-x-2 overflow-x-auto pb-2"
+                    "class": tw("flex space-x-2 overflow-x-auto pb-2")
                 },
                 *[
-                    html.button(
-                        {
-                            "key": cat,
-                            "class": f"px-4 py-2 rounded-full whitespace-nowrap {'bg-blue-600 text-white' if product_controller.current_category == cat else 'bg-gray-200 text-gray-700'}",
-                            "on_click": lambda event, cat=cat: handle_category_change(cat)
-                        },
-                        "Todos" if cat == "all" else cat.capitalize()
+                    facet_button(
+                        label,
+                        facet_counts["price_band"][band],
+                        selection.price_band == band,
+                        lambda event, band=band: handle_filter_change(
+                            price_band=None if selection.price_band == band else band
+                        ),
+                        key=band
                     )
-                    for cat in categories
+                    for band, label, _, _ in PRICE_BANDS
                 ]
+            ),
+            html.div(
+                {
+                    "class": tw("flex space-x-2 overflow-x-auto pb-2")
+                },
+                *[
+                    facet_button(
+                        f"{threshold}★ ou mais",
+                        facet_counts["min_rating"][threshold],
+                        selection.min_rating == threshold,
+                        lambda event, threshold=threshold: handle_filter_change(
+                            min_rating=None if selection.min_rating == threshold else threshold
+                        ),
+                        key=str(threshold)
+                    )
+                    for threshold in RATING_THRESHOLDS
+                ],
+                facet_button(
+                    "Em estoque",
+                    facet_counts["in_stock"][True],
+                    selection.in_stock,
+                    lambda event: handle_filter_change(in_stock=not selection.in_stock),
+                    key="in_stock"
+                )
+            ),
+            html.div(
+                {
+                    "class": tw("flex items-center space-x-2 pb-2")
+                },
+                html.label(
+                    {
+                        "class": tw("text-gray-600"),
+                        "html_for": "ordenar"
+                    },
+                    "Ordenar por:"
+                ),
+                html.select(
+                    {
+                        "id": "ordenar",
+                        "class": tw("border rounded-lg px-3 py-2"),
+                        "value": selection.sort,
+                        "on_change": lambda event: handle_filter_change(sort=event["target"]["value"])
+                    },
+                    *[
+                        html.option({"key": option, "value": option}, label)
+                        for option, (label, _, _) in SORT_OPTIONS.items()
+                    ]
+                )
             )
         ),
         html.div(
-            {
-                "class": "grid grid-cols-1 md:grid-cols-2 lg:grid-cols-4 gap-6"
-            },
-            *[
-                ProductCard(product, handle_add_to_cart)
-                for product in product_controller.filtered_products
-            ]
+            html.div(
+                {
+                    "class": tw("grid grid-cols-1 md:grid-cols-2 lg:grid-cols-4 gap-6")
+                },
+                *[
+                    ProductCard(product, handle_add_to_cart, key=product.id)
+                    for product in visible_products
+                ]
+            ),
+            html.div(
+                {
+                    "class": tw("text-center mt-6")
+                },
+                html.p(
+                    {
+                        "class": tw("text-sm text-gray-500 mb-2")
+                    },
+                    f"Mostrando {len(visible_products)} de {len(product_controller.filtered_products)} produtos"
+                ),
+                html.button(
+                    {
+                        "class": tw("bg-gray-200 text-gray-700 px-6 py-2 rounded-lg hover:bg-gray-300"),
+                        "on_click": handle_load_more
+                    },
+                    "Carregar mais produtos"
+                ) if next_cursor is not None else ""
+            )
         ) if product_controller.filtered_products else html.p(
             {
-                "class": "text-center text-gray-500 text-lg"
+                "class": tw("text-center text-gray-500 text-lg")
             },
             "Nenhum produto encontrado."
         )
     )
 
 @component
+@instrumented("component.ProductDetailPage", count_nodes=True)
 def ProductDetailPage(product_id, product_controller, cart_controller):
+    use_product_updates([product_id])
     product = product_controller.get_product_by_id(product_id)
+    handle_add_other = hooks.use_callback(
+        lambda other: cart_controller.add_to_cart(other), [cart_controller]
+    )
     
     if not product:
         return html.div(
             {
-                "class": "container mx-auto p-4 text-center"
+                "class": tw("container mx-auto p-4 text-center")
             },
             html.h1("Produto não encontrado"),
             html.p("O produto que você está procurando não existe.")
         )
     
-    def handle_add_to_cart():
+    display = get_product_display(product)
+    bought_together = product_controller.get_bought_together(product_id, recommender)
+    
+    def handle_add_to_cart(event):
         cart_controller.add_to_cart(product)
     
     return html.div(
         {
-            "class": "container mx-auto p-4"
+            "class": tw("container mx-auto p-4")
         },
         html.div(
             {
-                "class": "grid grid-cols-1 md:grid-cols-2 gap-8"
+                "class": tw("grid grid-cols-1 md:grid-cols-2 gap-8")
             },
             html.div(
                 html.img(
-                    {
-                        "src": product.image_url,
-                        "alt": product.name,
-                        "class": "w-full rounded-lg shadow-md"
-                    }
+                    product_image(
+                        product, tw("w-full rounded-lg shadow-md"), 600,
+                        sizes="(min-width: 768px) 50vw, 100vw", lazy=False
+                    )
                 )
             ),
             html.div(
                 html.h1(
                     {
-                        "class": "text-3xl font-bold mb-4"
+                        "class": tw("text-3xl font-bold mb-4")
                     },
                     product.name
                 ),
                 html.div(
                     {
-                        "class": "flex items-center mb-4"
+                        "class": tw("flex items-center mb-4")
                     },
                     html.span(
                         {
-                            "class": "text-yellow-500 mr-1 text-xl"
+                            "class": tw("text-yellow-500 mr-1 text-xl")
                         },
-                        "★" * int(product.rating)
+                        display.filled_stars
                     ),
                     html.span(
                         {
-                            "class": "text-gray-400 text-xl"
+                            "class": tw("text-gray-400 text-xl")
                         },
-                        "★" * (5 - int(product.rating))
+                        display.empty_stars
                     ),
                     html.span(
                         {
-                            "class": "text-gray-600 ml-2"
+                            "class": tw("text-gray-600 ml-2")
                         },
-                        f"({product.rating})"
+                        display.rating_label
                     )
                 ),
                 html.p(
                     {
-                        "class": "text-2xl font-bold text-blue-600 mb-4"
+                        "class": tw("text-2xl font-bold text-blue-600 mb-4")
                     },
-                    f"R$ {product.price:.2f}"
+                    display.price_label
                 ),
                 html.p(
                     {
-                        "class": "text-gray-700 mb-6"
+                        "class": tw("text-gray-700 mb-6")
                     },
                     product.description
                 ),
                 html.div(
                     {
-                        "class": "flex items-center mb-6"
+                        "class": tw("flex items-center mb-6")
                     },
                     html.span(
                         {
-                            "class": "text-gray-600 mr-4"
+                            "class": tw("text-gray-600 mr-4")
                         },
-                        f"Estoque: {product.stock}"
+                        display.stock_label
                     ),
                     html.span(
                         {
-                            "class": "px-3 py-1 bg-green-100 text-green-800 rounded-full text-sm"
+                            "class": tw("px-3 py-1 bg-green-100 text-green-800 rounded-full text-sm")
                         },
                         "Disponível" if product.stock > 0 else "Esgotado"
                     )
                 ),
                 html.button(
                     {
-                        "class": "bg-blue-600 text-white px-6 py-3 rounded-lg font-semibold hover:bg-blue-700 disabled:bg-gray-400",
+                        "class": tw("bg-blue-600 text-white px-6 py-3 rounded-lg font-semibold hover:bg-blue-700 disabled:bg-gray-400"),
                         "on_click": handle_add_to_cart,
                         "disabled": product.stock <= 0
                     },
                     "Adicionar ao Carrinho" if product.stock > 0 else "Produto Esgotado"
                 )
             )
-        )
+        ),
+        # Compre junto
+        html.div(
+            {
+                "class": tw("mt-12")
+            },
+            html.h2(
+                {
+                    "class": tw("text-2xl font-bold mb-6")
+                },
+                "Compre junto"
+            ),
+            html.div(
+                {
+                    "class": tw("grid grid-cols-1 md:grid-cols-2 lg:grid-cols-4 gap-6")
+                },
+                [ProductCard(other, handle_add_other, key=other.id) for other in bought_together]
+            )
+        ) if bought_together else ""
     )
 
 # ========== MAIN APP ==========
 
+# Settings, read from the environment so that every worker process sees
+# the same values.
+# Store the catalog in typed columns instead of one object per product
+COMPACT_CATALOG = os.environ.get("COMPACT_CATALOG") == "1"
+# Path of a SQLite catalog database; the sample products are used when unset
+CATALOG_DATABASE: Optional[str] = os.environ.get("CATALOG_DATABASE")
+# Directory caching resized product images served under IMAGE_ROUTE; the
+# original image URLs are used when unset. IMAGE_FIXTURE_DIR replaces the
+# network with a directory of local files (see LocalImageFetcher).
+IMAGE_CACHE_DIR: Optional[str] = os.environ.get("IMAGE_CACHE_DIR")
+IMAGE_FIXTURE_DIR: Optional[str] = os.environ.get("IMAGE_FIXTURE_DIR")
+# SQLite file holding sessions shared by all workers; in-process when unset
+SESSION_DATABASE: Optional[str] = os.environ.get("SESSION_DATABASE")
+# Serve the initial page as pre-rendered HTML instead of a blank shell
+PRERENDER_INITIAL_PAGE = os.environ.get("PRERENDER_INITIAL_PAGE") == "1"
+# permessage-deflate for clients that offer it. This is uvicorn's default;
+# WEBSOCKET_COMPRESSION=0 turns it off, e.g. behind a proxy that compresses
+# or when CPU matters more than bandwidth
+WEBSOCKET_COMPRESSION = os.environ.get("WEBSOCKET_COMPRESSION", "1") == "1"
+
+# Catalog is loaded once per process and shared by all connections
+product_catalog = ProductCatalog()
+if CATALOG_DATABASE:
+    product_catalog.load_from_repository(
+        SQLiteProductRepository(CATALOG_DATABASE), preload=PRODUCTS_PAGE_SIZE, compact=COMPACT_CATALOG
+    )
+elif COMPACT_CATALOG:
+    product_catalog.load_products(ColumnarProductStore.from_products(get_sample_products()))
+else:
+    product_catalog.load_products(get_sample_products())
+
+inventory = InventoryService(product_catalog)
+
+# Learns "compre junto" pairs from this process's carts
+recommender = CoOccurrenceRecommender()
+recommender.start()
+
+# Routes of the resized product images and of the generated stylesheet
+IMAGE_ROUTE = "/images"
+STATIC_ROUTE = "/static"
+
+image_service: Optional[ImageService] = None
+if IMAGE_CACHE_DIR:
+    image_service = ImageService(
+        IMAGE_CACHE_DIR,
+        fetch=LocalImageFetcher(IMAGE_FIXTURE_DIR) if IMAGE_FIXTURE_DIR else fetch_remote_image
+    )
+
+# Cookie holding the session id shared by every worker (see get_session_id)
+SESSION_COOKIE = "loja_session"
+
+session_store: SessionStore = (
+    SQLiteSessionStore(SESSION_DATABASE) if SESSION_DATABASE else InMemorySessionStore()
+)
+# Expired sessions are deleted on a save at most this often (seconds)
+SESSION_EXPIRE_EVERY = 3600
+next_session_expiry = 0.0
+cart_log: CartLog = SQLiteCartLog(SESSION_DATABASE) if SESSION_DATABASE else InMemoryCartLog()
+
+# Workers sharing a session database also share their catalog updates
+if SESSION_DATABASE:
+    product_catalog.changes.backend = SQLiteCatalogUpdates(SESSION_DATABASE)
+    product_catalog.changes.backend.start(product_catalog)
+
+# Carts of recently disconnected clients, kept with their stock reservations
+# so that a reconnecting client only replays the operations it missed
+MAX_IDLE_CARTS = 10_000
+idle_carts: "OrderedDict[str, CartController]" = OrderedDict()
+idle_carts_lock = threading.Lock()
+
+# Pages of the product grid that a listing URL may ask for up front
+MAX_INITIAL_PAGES = 10
+
+def get_session_id(connection) -> str:
+    # The server sets the session cookie on the index page, so a client
+    # reconnecting to any worker presents the same id
+    if connection is not None:
+        for name, value in connection.scope.get("headers", []):
+            if name == b"cookie":
+                cookie = SimpleCookie(value.decode("latin-1"))
+                if SESSION_COOKIE in cookie:
+                    return cookie[SESSION_COOKIE].value
+    return uuid4().hex
+
+def create_user_session(session_id: str) -> UserSession:
+    # Restores the login of a known session; new sessions start logged in
+    # as the sample user, as the store has no other users yet
+    user_session = UserSession()
+    data = session_store.load(session_id)
+    user_id = get_sample_user().id if data is None else data["user_id"]
+    if user_id == get_sample_user().id:
+        user_session.login(get_sample_user())
+    return user_session
+
+def create_cart_controller(session_id: str) -> CartController:
+    with idle_carts_lock:
+        cart_controller = idle_carts.pop(session_id, None)
+    if cart_controller is not None:
+        cart_controller.sync(notify=False)
+        return cart_controller
+    cart_controller = CartController(
+        inventory=inventory, log=cart_log, session_id=session_id, catalog=product_catalog, recommender=recommender
+    )
+    cart_controller.load()
+    return cart_controller
+
+def release_cart_controller(session_id: str, cart_controller: CartController):
+    # Called when a client disconnects
+    cart_controller.on_change = None
+    cart_controller.compact()
+    with idle_carts_lock:
+        idle_carts[session_id] = cart_controller
+        while len(idle_carts) > MAX_IDLE_CARTS:
+            _, evicted = idle_carts.popitem(last=False)
+            inventory.release_all(evicted.cart_id)
+
+def save_session(session_id: str, user_session: UserSession):
+    global next_session_expiry
+    session_store.save(session_id, {
+        "user_id": user_session.current_user.id if user_session.is_logged_in else None
+    })
+    if time.time() >= next_session_expiry:
+        next_session_expiry = time.time() + SESSION_EXPIRE_EVERY
+        session_store.expire()
+
+def parse_listing_query(search: str) -> Tuple[str, int]:
+    # "?categoria=livros&pagina=2" selects the initial category and grid page
+    params = parse_qs(search.lstrip("?"))
+    category = fold_text(params.get("categoria", ["all"])[0])
+    if category not in product_catalog.facets.options["category"]:
+        category = "all"
+    try:
+        page = int(params.get("pagina", ["1"])[0])
+    except ValueError:
+        page = 1
+    return category, min(max(page, 1), MAX_INITIAL_PAGES)
+
+def create_product_controller(category: str) -> ProductController:
+    product_controller = ProductController(product_catalog)
+    product_controller.filter_by_category(category)
+    return product_controller
+
 @component
+@instrumented("component.App", count_nodes=True)
 def App():
-    # Initialize controllers
-    product_controller = ProductController()
-    cart_controller = CartController()
-    user_session = UserSession()
+    # Without a backend connection (e.g. when pre-rendering) the URL is empty
+    connection = hooks.use_context(ConnectionContext)
+    initial_category, initial_page = parse_listing_query(connection.location.search if connection else "")
     
-    # Load sample data
-    product_controller.load_products(get_sample_products())
-    user_session.login(get_sample_user())
+    # Per-connection controllers, created on first render only
+    session_id = hooks.use_memo(lambda: get_session_id(connection), [])
+    product_controller = hooks.use_memo(lambda: create_product_controller(initial_category), [])
+    cart_controller = hooks.use_memo(lambda: create_cart_controller(session_id), [])
+    user_session = hooks.use_memo(lambda: create_user_session(session_id), [])
+    
+    # The cart logs its own changes; re-render when it changes
+    _, set_cart_version = hooks.use_state(0)
+    cart_controller.on_change = lambda: set_cart_version(lambda version: version + 1)
+    
+    @hooks.use_effect(dependencies=[])
+    def keep_session():
+        # Pre-rendered pages (no carrier) have no client to keep a session for
+        if connection is not None and connection.carrier is not None:
+            save_session(session_id, user_session)
+            return lambda: release_cart_controller(session_id, cart_controller)
     
     # State hooks
     show_cart, set_show_cart = hooks.use_state(False)
@@ -755,20 +3609,20 @@ def App():
     # Render appropriate page based on state
     def render_page():
         if current_page == "home":
-            return HomePage(product_controller, cart_controller)
+            return HomePage(product_controller, cart_controller, initial_page)
         elif current_page == "product_detail" and selected_product_id:
             return ProductDetailPage(selected_product_id, product_controller, cart_controller)
         else:
-            return HomePage(product_controller, cart_controller)
+            return HomePage(product_controller, cart_controller, initial_page)
     
     return html.div(
         {
-            "class": "min-h-screen bg-gray-100"
+            "class": tw("min-h-screen bg-gray-100")
         },
         Header(cart_controller, user_session, set_show_cart, set_current_page),
         html.main(
             {
-                "class": "container mx-auto py-6"
+                "class": tw("container mx-auto py-6")
             },
             render_page()
         ),
@@ -776,12 +3630,322 @@ def App():
         # Overlay when cart is open
         html.div(
             {
-                "class": f"fixed inset-0 bg-black bg-opacity-50 z-10 {'block' if show_cart else 'hidden'}",
+                "class": tw("fixed inset-0 bg-black bg-opacity-50 z-10", "block" if show_cart else "hidden"),
                 "on_click": lambda event: set_show_cart(False)
             }
         )
     )
 
+# ========== SERVER ==========
+
+# How long a pre-rendered page is reused before rendering it again
+PRERENDER_TTL_SECONDS = 30
+
+# One render at a time per event loop (see SerialLayout)
+_render_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
+
+def render_lock() -> asyncio.Lock:
+    loop = asyncio.get_running_loop()
+    lock = _render_locks.get(loop)
+    if lock is None:
+        lock = _render_locks[loop] = asyncio.Lock()
+    return lock
+
+class SerialLayout(Layout):
+    # ReactPy keeps the components being rendered on a per-thread stack but
+    # yields to the event loop between components, so two layouts rendering
+    # at once on one loop corrupt each other's stack ("Hook stack is in an
+    # invalid state"). Renders are CPU-bound anyway: they take turns.
+    async def _create_layout_update(self, old_state):
+        async with render_lock():
+            return await super()._create_layout_update(old_state)
+
+async def prerender_app(category: str, page: int) -> str:
+    # Render App once, without a websocket, and convert the VDOM to HTML
+    search = urlencode({"categoria": category, "pagina": page})
+    root = ConnectionContext(
+        App(), value=Connection(scope={}, location=Location("/", f"?{search}"), carrier=None)
+    )
+    async with SerialLayout(root) as layout:
+        update = await layout.render()
+    return vdom_to_html(update["model"])
+
+class PrerenderCache:
+    # Pre-rendered HTML keyed by (category, page). Concurrent requests for
+    # the same key share a single render.
+    def __init__(self, ttl: float = PRERENDER_TTL_SECONDS, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: Dict[Tuple[str, int], Tuple[float, "asyncio.Task[str]"]] = {}
+    
+    async def get(self, category: str, page: int) -> str:
+        key = (category, page)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= self.clock():
+            entry = self._entries[key] = (
+                self.clock() + self.ttl,
+                asyncio.ensure_future(prerender_app(category, page))
+            )
+        try:
+            return await asyncio.shield(entry[1])
+        except Exception:
+            self._entries.pop(key, None)
+            raise
+    
+    def clear(self):
+        self._entries.clear()
+
+# Layout updates rendered within one frame go out together, and updates
+# inside a subtree that is already pending are merged into it
+UPDATE_FRAME_SECONDS = 1 / 60
+
+def replace_at_path(root: Dict, path: str, model: Dict) -> Dict:
+    # Copy of `root` with the node at JSON pointer `path` replaced. Nodes
+    # along the path are copied, since the layout shares them between renders.
+    if not path:
+        return model
+    keys = path.split("/")[1:]
+    def rebuild(node, depth):
+        key = int(keys[depth]) if isinstance(node, list) else keys[depth]
+        copy = list(node) if isinstance(node, list) else dict(node)
+        copy[key] = model if depth == len(keys) - 1 else rebuild(node[key], depth + 1)
+        return copy
+    return rebuild(root, 0)
+
+def node_at_path(root: Dict, path: str) -> Dict:
+    node = root
+    for key in path.split("/")[1:]:
+        node = node[int(key)] if isinstance(node, list) else node[key]
+    return node
+
+class UpdateCoalescer:
+    # Mirrors the client's model and turns the layout updates of one frame
+    # into one message per updated subtree
+    def __init__(self):
+        self.model: Dict = {}
+        self._pending: Set[str] = set()
+    
+    def add(self, update: Dict):
+        self.model = replace_at_path(self.model, update["path"], update["model"])
+        self._pending.add(update["path"])
+    
+    def drain(self) -> List[Dict]:
+        # Sorted paths put every subtree right after its root
+        roots: List[str] = []
+        for path in sorted(self._pending):
+            if roots and (path == roots[-1] or path.startswith(roots[-1] + "/")):
+                continue
+            roots.append(path)
+        self._pending.clear()
+        return [
+            {"type": "layout-update", "path": path, "model": node_at_path(self.model, path)}
+            for path in roots
+        ]
+
+class ConnectionStats:
+    # Layout updates rendered and messages sent on one websocket
+    def __init__(self, path: str, clock: Callable[[], float] = time.monotonic):
+        self.path = path
+        self.clock = clock
+        self.started = clock()
+        self.updates = 0
+        self.messages = 0
+        self.bytes = 0
+    
+    def to_dict(self) -> Dict:
+        elapsed = max(self.clock() - self.started, 1e-9)
+        return {
+            "path": self.path, "seconds": round(elapsed, 3), "updates": self.updates,
+            "messages": self.messages, "bytes": self.bytes,
+            "messages_per_second": round(self.messages / elapsed, 3),
+            "bytes_per_second": round(self.bytes / elapsed, 3),
+        }
+
+connection_stats: Dict[str, ConnectionStats] = {}
+
+async def serve_layout_coalesced(layout: Layout, send_text, receive_text, stats: ConnectionStats,
+                                 frame_seconds: float = UPDATE_FRAME_SECONDS):
+    # Replaces reactpy's serve_layout: renders are collected for up to one
+    # frame after the first of a burst, then sent as coalesced messages
+    updates: "asyncio.Queue[Dict]" = asyncio.Queue()
+    coalescer = UpdateCoalescer()
+    events: Set[asyncio.Task] = set()
+    loop = asyncio.get_running_loop()
+    
+    async def render():
+        # Never cancelled mid-render, unlike a render awaited with a timeout
+        while True:
+            await updates.put(await layout.render())
+            stats.updates += 1
+    
+    async def send():
+        while True:
+            coalescer.add(await updates.get())
+            deadline = loop.time() + frame_seconds
+            while True:
+                try:
+                    coalescer.add(await asyncio.wait_for(updates.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            for message in coalescer.drain():
+                text = json.dumps(message, separators=(",", ":"))
+                await send_text(text)
+                stats.messages += 1
+                stats.bytes += len(text.encode())
+    
+    async def receive():
+        while True:
+            task = asyncio.ensure_future(layout.deliver(json.loads(await receive_text())))
+            events.add(task)
+            task.add_done_callback(events.discard)
+    
+    async with layout:
+        tasks = [asyncio.ensure_future(run()) for run in (render, send, receive)]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in (*tasks, *events):
+                task.cancel()
+        for task in done:
+            task.result()
+
+def page_head():
+    # The stylesheet URL carries its content hash, so it can be cached
+    # until build_css.py changes it
+    head = [html.title("Loja ReactPy")]
+    if STYLESHEET_FILE.exists():
+        version = hashlib.sha1(STYLESHEET_FILE.read_bytes()).hexdigest()[:8]
+        head.append(html.link({"rel": "stylesheet", "href": f"{STATIC_ROUTE}/{STYLESHEET_FILE.name}?v={version}"}))
+    return html.head(*head)
+
+def create_server_app(prerender: bool = PRERENDER_INITIAL_PAGE):
+    # Starlette app serving App. With `prerender`, the index page already
+    # contains the rendered HTML, which the client replaces with the live
+    # layout once its websocket connects.
+    from starlette.applications import Starlette
+    from starlette.responses import HTMLResponse
+    from reactpy.backend._common import STREAM_PATH, read_client_index_html
+    from reactpy.backend.starlette import Options, configure
+    
+    server = Starlette()
+    options = Options(head=page_head())
+    
+    @server.middleware("http")
+    async def set_session_cookie(request, call_next):
+        response = await call_next(request)
+        if SESSION_COOKIE not in request.cookies:
+            response.set_cookie(SESSION_COOKIE, uuid4().hex, httponly=True, samesite="lax")
+        return response
+    
+    async def stream_layout(socket):
+        # Same connection setup as reactpy's own stream route, which this
+        # one shadows, but serving coalesced updates
+        from starlette.websockets import WebSocketDisconnect
+        await socket.accept()
+        pathname = "/" + socket.scope["path_params"].get("path", "")
+        search = socket.scope["query_string"].decode()
+        connection = Connection(
+            scope=socket.scope, location=Location(pathname, f"?{search}" if search else ""), carrier=socket
+        )
+        stats_key = uuid4().hex
+        stats = connection_stats[stats_key] = ConnectionStats(pathname)
+        try:
+            await serve_layout_coalesced(
+                SerialLayout(ConnectionContext(App(), value=connection)), socket.send_text, socket.receive_text, stats
+            )
+        except WebSocketDisconnect:
+            pass
+        finally:
+            connection_stats.pop(stats_key, None)
+    
+    # Registered before configure() so they take priority over reactpy's
+    server.add_websocket_route(str(STREAM_PATH), stream_layout)
+    server.add_websocket_route(f"{STREAM_PATH}/{{path:path}}", stream_layout)
+    if prerender:
+        index_html = read_client_index_html(options)
+        cache = PrerenderCache()
+        
+        async def serve_prerendered_index(request):
+            category, page = parse_listing_query(request.url.query)
+            body = await cache.get(category, page)
+            return HTMLResponse(index_html.replace('<div id="app"></div>', f'<div id="app">{body}</div>'))
+        
+        # Registered before configure() so it takes priority over the blank index
+        server.add_route("/", serve_prerendered_index)
+    if image_service is not None:
+        from starlette.responses import FileResponse, RedirectResponse, Response
+        
+        async def serve_image(request):
+            product = product_catalog.get(request.path_params["product_id"])
+            width = request.path_params["width"]
+            if product is None or width not in IMAGE_WIDTHS:
+                return Response(status_code=404)
+            try:
+                path = await asyncio.to_thread(image_service.variant, product.image_url, width)
+            except Exception:
+                # Unreachable or undecodable originals fall back to the source URL
+                return RedirectResponse(product.image_url)
+            current = request.query_params.get("v") == ImageService.key(product.image_url)[:8]
+            return FileResponse(path, media_type="image/webp", headers={
+                "Cache-Control": "public, max-age=31536000, immutable" if current else "no-cache"
+            })
+        
+        server.add_route(IMAGE_ROUTE + "/{product_id:int}/{width:int}.webp", serve_image)
+    if INSTRUMENTATION_ENABLED:
+        from starlette.responses import PlainTextResponse, Response
+        
+        async def serve_metrics(request):
+            if request.url.path.endswith(".json"):
+                return Response(metrics.to_json(), media_type="application/json")
+            return PlainTextResponse(metrics.to_prometheus())
+        
+        async def serve_connection_metrics(request):
+            # Messages and payload bytes (before compression) per open websocket
+            stats = [stat.to_dict() for stat in list(connection_stats.values())]
+            return Response(json.dumps(stats, indent=2), media_type="application/json")
+        
+        async def serve_profile(request):
+            # Samples the event loop thread for ?seconds=N (default 5)
+            profiler = SamplingProfiler()
+            profiler.start()
+            await asyncio.sleep(min(float(request.query_params.get("seconds", 5)), 60))
+            profiler.stop()
+            return PlainTextResponse(profiler.collapsed())
+        
+        server.add_route("/metrics", serve_metrics)
+        server.add_route("/metrics.json", serve_metrics)
+        server.add_route("/metrics/connections.json", serve_connection_metrics)
+        server.add_route("/profile", serve_profile)
+    if STYLESHEET_FILE.exists():
+        from starlette.staticfiles import StaticFiles
+        server.mount(STATIC_ROUTE, StaticFiles(directory=STATIC_DIR), name="static")
+    configure(server, App, options)
+    return server
+
+def serve(workers: int = 1, host: str = "127.0.0.1", port: int = 8000, session_database: str = None):
+    # Production launcher: uvicorn runs `workers` processes, each importing
+    # this module and building its own app through create_server_app
+    import uvicorn
+    if session_database:
+        os.environ["SESSION_DATABASE"] = session_database
+    if workers > 1 and not os.environ.get("SESSION_DATABASE"):
+        raise ValueError("Running several workers requires a shared session database")
+    uvicorn.run(
+        f"{Path(__file__).stem}:create_server_app", factory=True, workers=workers,
+        host=host, port=port, app_dir=str(Path(__file__).parent), ws_per_message_deflate=WEBSOCKET_COMPRESSION
+    )
+
 # Run the application
 if __name__ == "__main__":
-    run(App)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Loja ReactPy")
+    parser.add_argument("--workers", type=int, default=0, help="serve with uvicorn using this many worker processes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--session-db", help="SQLite file shared by the workers for carts and sessions")
+    args = parser.parse_args()
+    if args.workers:
+        serve(args.workers, args.host, args.port, args.session_db)
+    else:
+        # Served through create_server_app so the stylesheet is mounted too
+        import uvicorn
+        uvicorn.run(create_server_app(), host=args.host, port=args.port, ws_per_message_deflate=WEBSOCKET_COMPRESSION)
\ No newline at end of file
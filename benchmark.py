@@ -0,0 +1,524 @@
+"""Benchmarks for the catalog, search, cart and render hot paths of app.py.
+
+Run the suite and store the results:
+
+    python benchmark.py --sizes 1000,100000 --output results.json
+
+Compare a new run against stored results, failing on regressions:
+
+    python benchmark.py --baseline results.json
+
+Catalogs of 1,000,000 products are supported (--sizes 1000,100000,1000000)
+but building their search index takes several minutes and a few GB of RAM.
+
+The "compre junto" matrix is built from --cooccurrence-events synthetic
+cart events (default 1,000,000; use 10000000 for the full-size run).
+
+Memory of the product representations is measured at --memory-sizes
+(default 10000,100000,1000000; empty to skip), and that of whole loaded
+catalogs, object rows against COMPACT_CATALOG, at --catalog-memory-sizes
+(default 10000,100000; empty to skip).
+
+First-byte and first-content times of the index page are compared with
+and without PRERENDER_INITIAL_PAGE over --first-paint-requests requests
+(default 30; 0 to skip).
+
+Load-test the multi-worker server, one run per worker count, with client
+sessions that open the page, add a product to the cart and disconnect:
+
+    python benchmark.py --sizes 0 --cooccurrence-events 0 --load-test-workers 1,2,4
+"""
+import argparse
+import asyncio
+import dataclasses
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from reactpy import component, hooks
+from reactpy.core import vdom as vdom_module
+from reactpy.core.layout import Layout
+
+import app
+
+WORDS = [
+    "smartphone", "notebook", "camiseta", "tênis", "livro", "fone", "mochila",
+    "relógio", "câmera", "básica", "esportivo", "python", "bluetooth",
+    "executiva", "premium", "algodão", "tela", "bateria", "sem", "fio",
+]
+CATEGORIES = ["eletronicos", "roupas", "calcados", "livros", "acessorios"]
+QUERIES = ["note", "câmera", "camera", "tela premium", "xyz", "a", "notbook"]
+
+
+def make_products(count, seed=0):
+    rnd = random.Random(seed)
+    return [
+        app.Product(
+            id=i,
+            name=f"{rnd.choice(WORDS).capitalize()} {rnd.choice(WORDS)} {i}",
+            description=" ".join(rnd.choice(WORDS) for _ in range(12)),
+            price=round(rnd.uniform(5, 5000), 2),
+            image_url=f"https://example.com/products/{i}.jpg",
+            category=rnd.choice(CATEGORIES),
+            stock=rnd.randint(0, 100),
+            rating=round(rnd.uniform(1, 5), 1),
+        )
+        for i in range(1, count + 1)
+    ]
+
+
+def measure(function, repeat=5, min_time=0.05):
+    # Calibrates the number of calls per sample like timeit.autorange, then
+    # returns per-call timings of `repeat` samples
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number *= 10
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        samples.append((time.perf_counter() - start) / number)
+    return {"median_s": statistics.median(samples), "min_s": min(samples), "calls": number * repeat}
+
+
+def render(loop, component):
+    async def render_once():
+        async with Layout(component) as layout:
+            await layout.render()
+    loop.run_until_complete(render_once())
+
+
+def count_elements(node):
+    # Like app.count_vdom_nodes, without the nodes of the components themselves
+    if not isinstance(node, dict):
+        return 0
+    return bool(node.get("tagName")) + sum(count_elements(child) for child in node.get("children", ()))
+
+
+@component
+def Storefront(product_controller, cart_controller):
+    # HomePage under a parent that re-renders on every cart change, as App does
+    _, set_cart_version = hooks.use_state(0)
+    cart_controller.on_change = lambda: set_cart_version(lambda version: version + 1)
+    return app.HomePage(product_controller, cart_controller)
+
+
+def rebuilt_nodes(loop, product_controller):
+    # VDOM elements built when adding a product to the cart re-renders the
+    # page, against the elements on the page, which is what every render
+    # built before ProductCard was memoized
+    built = 0
+    vdom = vdom_module.vdom
+
+    def counting_vdom(*args, **kwargs):
+        nonlocal built
+        built += 1
+        return vdom(*args, **kwargs)
+
+    async def add_to_cart():
+        async with Layout(Storefront(product_controller, app.CartController())) as layout:
+            model = (await layout.render())["model"]
+            target = find_handler(model, "on_click", "Adicionar ao Carrinho")
+            vdom_module.vdom = counting_vdom
+            try:
+                await layout.deliver({"type": "layout-event", "target": target, "data": [{}]})
+                update = await layout.render()
+            finally:
+                vdom_module.vdom = vdom
+            return count_elements(app.replace_at_path(model, update["path"], update["model"]))
+
+    total = loop.run_until_complete(add_to_cart())
+    return {"median_s": None, "min_s": None, "calls": 1, "nodes": built, "page_nodes": total}
+
+
+def run_suite(sizes, repeat):
+    results = {}
+    loop = asyncio.new_event_loop()
+    for size in sizes:
+        products = make_products(size)
+        catalog = app.ProductCatalog()
+        start = time.perf_counter()
+        catalog.load_products(products)
+        results[f"load_products[n={size}]"] = {"median_s": time.perf_counter() - start, "min_s": None, "calls": 1}
+        controller = app.ProductController(catalog)
+        rnd = random.Random(size)
+        ids = [rnd.randint(1, size) for _ in range(1000)]
+
+        benchmarks = {
+            "get_product_by_id": lambda: [controller.get_product_by_id(i) for i in ids],
+            "filter_by_category[all]": lambda: controller.filter_by_category("all"),
+            "filter_by_category[livros]": lambda: controller.filter_by_category("livros"),
+        }
+        sorted_controller = app.ProductController(catalog)
+        for sort in ("menor_preco", "avaliacao"):
+            benchmarks[f"sorted_page[{sort},livros]"] = lambda sort=sort: (
+                sorted_controller.apply_filters(category="livros", sort=sort),
+                sorted_controller.get_page(0, app.PRODUCTS_PAGE_SIZE),
+            )
+        for query in QUERIES:
+            benchmarks[f"search_products[{query}]"] = lambda query=query: controller.search_products(query)
+        # Repeated queries above are served by the result cache; these miss it
+        for query in ("note", "notbook"):
+            benchmarks[f"search_products[uncached,{query}]"] = lambda query=query: (
+                catalog.search_index.clear_cache(), controller.search_products(query)
+            )
+
+        cart_controller = app.CartController()
+        for product in products[:50]:
+            cart_controller.add_to_cart(product, 2)
+        benchmarks["ShoppingCart.get_total"] = cart_controller.cart.get_total
+        benchmarks["ShoppingCart.get_items_count"] = cart_controller.cart.get_items_count
+
+        # A controller of its own: the search benchmarks above leave their
+        # last query on `controller`, and the full grid is what is measured
+        home_controller = app.ProductController(catalog)
+        benchmarks["render.HomePage"] = lambda: render(loop, app.HomePage(home_controller, cart_controller))
+        results[f"render.nodes_rebuilt[n={size}]"] = rebuilt_nodes(loop, home_controller)
+        print(f"render.nodes_rebuilt[n={size}]: {results[f'render.nodes_rebuilt[n={size}]']['nodes']} of "
+              f"{results[f'render.nodes_rebuilt[n={size}]']['page_nodes']} nodes", file=sys.stderr)
+        benchmarks["render.CartSidebar"] = lambda: render(loop, app.CartSidebar(True, lambda value: None, cart_controller))
+        # Last, since they change the catalog the benchmarks above read. The
+        # discount is undone every other call, so prices don't decay to 0.
+        price_factors = itertools.cycle((0.9, 1 / 0.9))
+        benchmarks["bulk_update[price*0.9,livros]"] = lambda: catalog.bulk_update(
+            app.FacetSelection(category="livros"), price=("multiply", next(price_factors))
+        )
+        benchmarks["bulk_update[stock+1,all]"] = lambda: catalog.bulk_update(stock=("add", 1))
+
+        for name, function in benchmarks.items():
+            results[f"{name}[n={size}]"] = measure(function, repeat)
+            print(f"{name}[n={size}]: {results[f'{name}[n={size}]']['median_s'] * 1e6:.1f} us", file=sys.stderr)
+    loop.close()
+    return results
+
+
+def run_cooccurrence(events, catalog_size=10_000, chunk=1_000_000, seed=0):
+    # Builds the "compre junto" matrix from synthetic cart events: carts of
+    # 1-8 products drawn with a Zipf-like popularity, a fifth of them
+    # checked out. Events are folded in chunks, as the background job does;
+    # only process_events() and compute_neighbors() are timed.
+    rnd = random.Random(seed)
+    cum_weights = []
+    total = 0.0
+    for rank in range(1, catalog_size + 1):
+        total += 1 / rank
+        cum_weights.append(total)
+    population = range(1, catalog_size + 1)
+    recommender = app.CoOccurrenceRecommender()
+    folded = 0
+    elapsed = 0.0
+    cart = 0
+    while folded < events:
+        count = min(chunk, events - folded)
+        product_ids = rnd.choices(population, cum_weights=cum_weights, k=count)
+        position = 0
+        while position < count:
+            size = rnd.randint(1, 8)
+            cart_id = f"c{cart}"
+            for product_id in product_ids[position:position + size]:
+                recommender.record_add(cart_id, product_id)
+            if cart % 5 == 0:
+                recommender.record_checkout(cart_id, product_ids[position:position + size])
+            position += size
+            cart += 1
+        start = time.perf_counter()
+        recommender.process_events()
+        elapsed += time.perf_counter() - start
+        folded += count
+    start = time.perf_counter()
+    recommender.compute_neighbors()
+    neighbors_elapsed = time.perf_counter() - start
+    print(
+        f"cooccurrence[events={events}]: fold {elapsed:.2f} s, neighbors {neighbors_elapsed:.2f} s, "
+        f"{len(recommender.pair_counts)} pairs, {len(recommender.neighbors)} rows",
+        file=sys.stderr,
+    )
+    return {
+        f"cooccurrence.process_events[events={events}]": {"median_s": elapsed, "min_s": None, "calls": 1},
+        f"cooccurrence.compute_neighbors[events={events}]": {"median_s": neighbors_elapsed, "min_s": None, "calls": 1},
+    }
+
+
+# Product as it was before it got __slots__, for the memory comparison
+DictProduct = dataclasses.make_dataclass(
+    "DictProduct", [(field.name, field.type, field) for field in dataclasses.fields(app.Product)]
+)
+
+
+def product_representations(products):
+    return {
+        "dataclass": lambda: [DictProduct(*dataclasses.astuple(product)) for product in products],
+        "slotted": lambda: [app.Product(*dataclasses.astuple(product)) for product in products],
+        "columnar": lambda: app.ColumnarProductStore.from_products(products),
+    }
+
+
+def loaded_catalog(products):
+    catalog = app.ProductCatalog()
+    catalog.load_products(products)
+    return catalog
+
+
+def catalog_representations(products):
+    # Whole catalogs, indexes included, over object rows and over COMPACT_CATALOG
+    return {
+        "catalog.object": lambda: loaded_catalog([app.Product(*dataclasses.astuple(product)) for product in products]),
+        "catalog.compact": lambda: loaded_catalog(app.ColumnarProductStore.from_products(products)),
+    }
+
+
+def run_memory(sizes, catalog_sizes):
+    # Bytes held by each representation of a catalog of `size` products,
+    # and by whole loaded catalogs at `catalog_sizes`, measured with
+    # tracemalloc. The source products are built first, so their strings
+    # are shared and not counted.
+    results = {}
+    for size in sorted(set(sizes) | set(catalog_sizes)):
+        products = make_products(size)
+        representations = product_representations(products) if size in sizes else {}
+        if size in catalog_sizes:
+            representations.update(catalog_representations(products))
+        for name, build in representations.items():
+            tracemalloc.start()
+            catalog = build()
+            allocated = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del catalog
+            print(f"memory.{name}[n={size}]: {allocated / 1e6:.1f} MB, {allocated / size:.0f} B/product",
+                  file=sys.stderr)
+            results[f"memory.{name}[n={size}]"] = {"median_s": None, "min_s": None, "calls": 1, "bytes": allocated}
+    return results
+
+
+def find_handler(node, event, text):
+    # Target of the first `event` handler of an element containing `text`
+    if not isinstance(node, dict):
+        return None
+    handler = node.get("eventHandlers", {}).get(event)
+    if handler and text in json.dumps(node.get("children", []), ensure_ascii=False):
+        return handler["target"]
+    for child in node.get("children", []):
+        target = find_handler(child, event, text)
+        if target:
+            return target
+    return None
+
+
+async def client_sessions(port, duration, connections):
+    # Runs `connections` concurrent client loops for `duration` seconds;
+    # returns the number of completed sessions. A session opens the page,
+    # adds the first product to the cart, opens "Produtos" and disconnects.
+    from websockets.asyncio.client import connect
+
+    url = f"ws://127.0.0.1:{port}/_reactpy/stream"
+    deadline = time.perf_counter() + duration
+    completed = 0
+
+    async def session_loop():
+        nonlocal completed
+        while time.perf_counter() < deadline:
+            # A fresh session per visit, its cookie shared by whichever worker serves it
+            cookie = f"{app.SESSION_COOKIE}={uuid.uuid4().hex}"
+            async with connect(url, additional_headers={"Cookie": cookie}, max_size=None) as websocket:
+                model = json.loads(await asyncio.wait_for(websocket.recv(), 30))["model"]
+                # Adding changes nothing once the stock is all reserved; the
+                # "Produtos" page always re-renders
+                for text in ("Adicionar ao Carrinho", "Produtos"):
+                    target = find_handler(model, "on_click", text)
+                    await websocket.send(json.dumps({"type": "layout-event", "target": target, "data": [{}]}))
+                await asyncio.wait_for(websocket.recv(), 30)
+            completed += 1
+
+    await asyncio.gather(*(session_loop() for _ in range(connections)))
+    return completed
+
+
+def run_client(port, duration, connections):
+    return asyncio.run(client_sessions(port, duration, connections))
+
+
+def wait_for_server(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"server on port {port} did not start")
+
+
+async def first_paint(port, marker=b"Adicionar ao Carrinho"):
+    # Seconds from sending GET / to the first response byte, and to the
+    # first products: in the HTML when it is pre-rendered, otherwise in the
+    # first update of the websocket the client opens next
+    from websockets.asyncio.client import connect
+
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET / HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nConnection: close\r\n\r\n".encode())
+    response = await reader.read(65536)
+    first_byte = time.perf_counter() - start
+    first_content = first_byte if marker in response else None
+    while first_content is None and (chunk := await reader.read(65536)):
+        response += chunk
+        if marker in response:
+            first_content = time.perf_counter() - start
+    writer.close()
+    if first_content is None:
+        async with connect(f"ws://127.0.0.1:{port}/_reactpy/stream", max_size=None) as websocket:
+            update = await websocket.recv()
+            first_content = time.perf_counter() - start
+        if marker.decode() not in update:
+            raise RuntimeError("the first update has no products")
+    return first_byte, first_content
+
+
+def run_first_paint(requests=30, port=8765):
+    # Starts `python app.py` serving a blank shell, then pre-rendered pages,
+    # and times `requests` page loads of each after a warm-up load
+    results = {}
+    for mode, prerender in (("shell", "0"), ("prerendered", "1")):
+        server = subprocess.Popen(
+            [sys.executable, str(Path(app.__file__)), "--port", str(port)],
+            env={**os.environ, "PRERENDER_INITIAL_PAGE": prerender},
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_server(port)
+            asyncio.run(first_paint(port))
+            samples = [asyncio.run(first_paint(port)) for _ in range(requests)]
+        finally:
+            server.terminate()
+            server.wait()
+        for index, name in enumerate(("first_byte", "first_content")):
+            timings = [sample[index] for sample in samples]
+            results[f"{name}[{mode}]"] = {
+                "median_s": statistics.median(timings), "min_s": min(timings), "calls": requests,
+            }
+            print(f"{name}[{mode}]: {statistics.median(timings) * 1e3:.1f} ms", file=sys.stderr)
+    return results
+
+
+def run_load_test(worker_counts, duration=10.0, clients=4, connections=16, port=8765):
+    # Starts `python app.py --workers N` sharing a temporary session
+    # database, then drives it from `clients` processes for `duration`
+    # seconds. Clients are separate processes so they don't share the GIL.
+    results = {}
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            server = subprocess.Popen(
+                [sys.executable, str(Path(app.__file__)), "--workers", str(workers), "--port", str(port),
+                 "--session-db", os.path.join(directory, "sessions.db")],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            try:
+                wait_for_server(port)
+                # Warm up every worker before measuring
+                run_client(port, 2.0, workers * 2)
+                with ProcessPoolExecutor(clients) as pool:
+                    sessions = sum(pool.map(run_client, [port] * clients, [duration] * clients, [connections] * clients))
+            finally:
+                server.terminate()
+                server.wait()
+        throughput = sessions / duration
+        print(f"load_test[workers={workers}]: {throughput:.1f} sessions/s", file=sys.stderr)
+        results[f"load_test[workers={workers}]"] = {
+            "median_s": 1 / throughput if throughput else None, "min_s": None, "calls": sessions,
+            "sessions_per_s": throughput,
+        }
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Returns the names of benchmarks slower (or, for memory and rebuilt
+    # nodes, bigger) than the baseline by more than `threshold` (a fraction), printing the ratio
+    # of every common benchmark
+    regressions = []
+    for name, result in sorted(results.items()):
+        previous = baseline.get(name)
+        metric = next((key for key in ("bytes", "nodes") if key in result), "median_s")
+        if previous is None or not previous.get(metric):
+            continue
+        ratio = result[metric] / previous[metric]
+        marker = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            marker = "  REGRESSION"
+        print(f"{name}: {ratio:.2f}x baseline{marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,100000", help="comma separated catalog sizes")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown before failing")
+    parser.add_argument("--cooccurrence-events", type=int, default=1_000_000,
+                        help="synthetic cart events for the recommendations benchmark (0 to skip)")
+    parser.add_argument("--memory-sizes", default="10000,100000,1000000",
+                        help="comma separated catalog sizes for the memory benchmark (empty to skip)")
+    parser.add_argument("--catalog-memory-sizes", default="10000,100000",
+                        help="comma separated sizes of the whole-catalog memory benchmark (empty to skip)")
+    parser.add_argument("--first-paint-requests", type=int, default=30,
+                        help="page loads per mode for the first-paint comparison (0 to skip)")
+    parser.add_argument("--load-test-workers", default="",
+                        help="comma separated worker counts to load-test the server with (empty to skip)")
+    parser.add_argument("--load-test-seconds", type=float, default=10.0)
+    args = parser.parse_args()
+
+    results = run_suite([int(size) for size in args.sizes.split(",") if int(size)], args.repeat)
+    if args.cooccurrence_events:
+        results.update(run_cooccurrence(args.cooccurrence_events))
+    if args.memory_sizes or args.catalog_memory_sizes:
+        results.update(run_memory(
+            [int(size) for size in args.memory_sizes.split(",") if size],
+            [int(size) for size in args.catalog_memory_sizes.split(",") if size],
+        ))
+    if args.first_paint_requests:
+        results.update(run_first_paint(args.first_paint_requests))
+    if args.load_test_workers:
+        worker_counts = [int(workers) for workers in args.load_test_workers.split(",")]
+        results.update(run_load_test(worker_counts, args.load_test_seconds))
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
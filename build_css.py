@@ -0,0 +1,311 @@
+"""Compiles the Tailwind class strings of app.py into short class names.
+
+Every string literal passed to tw() in app.py gets a short generated name
+(c0, c1, ...). The build writes:
+
+    static/class_names.json   class string -> short name, read by app.tw()
+    static/styles.css         the rules of every short name
+
+Run it after changing a tw() call:
+
+    python build_css.py
+
+Use --check to fail when the generated files are out of date. Only the
+Tailwind utilities listed below are known; an unknown utility fails the
+build instead of silently rendering unstyled.
+"""
+import argparse
+import ast
+import json
+import re
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent
+SOURCE = ROOT / "app.py"
+STATIC_DIR = ROOT / "static"
+
+SCREENS = {"sm": "640px", "md": "768px", "lg": "1024px", "xl": "1280px"}
+STATES = {"hover": ":hover", "focus": ":focus", "disabled": ":disabled"}
+
+COLORS = {
+    "black": "0 0 0",
+    "white": "255 255 255",
+    "gray-100": "243 244 246",
+    "gray-200": "229 231 235",
+    "gray-300": "209 213 219",
+    "gray-400": "156 163 175",
+    "gray-500": "107 114 128",
+    "gray-600": "75 85 99",
+    "gray-700": "55 65 81",
+    "blue-100": "219 234 254",
+    "blue-200": "191 219 254",
+    "blue-500": "59 130 246",
+    "blue-600": "37 99 235",
+    "blue-700": "29 78 216",
+    "blue-800": "30 64 175",
+    "green-100": "220 252 231",
+    "green-600": "22 163 74",
+    "green-700": "21 128 61",
+    "green-800": "22 101 52",
+    "red-500": "239 68 68",
+    "red-700": "185 28 28",
+    "yellow-500": "234 179 8",
+}
+FONT_SIZES = {
+    "xs": ("0.75rem", "1rem"),
+    "sm": ("0.875rem", "1.25rem"),
+    "base": ("1rem", "1.5rem"),
+    "lg": ("1.125rem", "1.75rem"),
+    "xl": ("1.25rem", "1.75rem"),
+    "2xl": ("1.5rem", "2rem"),
+    "3xl": ("1.875rem", "2.25rem"),
+}
+FONT_WEIGHTS = {"normal": 400, "medium": 500, "semibold": 600, "bold": 700}
+RADII = {"": "0.25rem", "md": "0.375rem", "lg": "0.5rem", "full": "9999px"}
+SHADOWS = {
+    "md": "0 4px 6px -1px rgb(0 0 0 / 0.1), 0 2px 4px -2px rgb(0 0 0 / 0.1)",
+    "lg": "0 10px 15px -3px rgb(0 0 0 / 0.1), 0 4px 6px -4px rgb(0 0 0 / 0.1)",
+}
+TRANSITIONS = {
+    "colors": "color, background-color, border-color, text-decoration-color, fill, stroke",
+    "shadow": "box-shadow",
+    "transform": "transform",
+}
+STATIC = {
+    "block": "display: block",
+    "inline": "display: inline",
+    "flex": "display: flex",
+    "grid": "display: grid",
+    "hidden": "display: none",
+    "flex-col": "flex-direction: column",
+    "flex-grow": "flex-grow: 1",
+    "items-center": "align-items: center",
+    "justify-center": "justify-content: center",
+    "justify-between": "justify-content: space-between",
+    "static": "position: static",
+    "fixed": "position: fixed",
+    "absolute": "position: absolute",
+    "relative": "position: relative",
+    "sticky": "position: sticky",
+    "overflow-hidden": "overflow: hidden",
+    "overflow-x-auto": "overflow-x: auto",
+    "overflow-y-auto": "overflow-y: auto",
+    "object-cover": "object-fit: cover",
+    "cursor-pointer": "cursor: pointer",
+    "whitespace-nowrap": "white-space: nowrap",
+    "text-left": "text-align: left",
+    "text-center": "text-align: center",
+    "text-right": "text-align: right",
+    "min-h-screen": "min-height: 100vh",
+    "border": "border-width: 1px",
+    "border-t": "border-top-width: 1px",
+    "border-b": "border-bottom-width: 1px",
+    "transform": "transform: translateX(var(--tw-translate-x, 0))",
+}
+SIDES = {
+    "": ("",), "x": ("-left", "-right"), "y": ("-top", "-bottom"),
+    "t": ("-top",), "r": ("-right",), "b": ("-bottom",), "l": ("-left",),
+}
+PREFLIGHT = """*, ::before, ::after { box-sizing: border-box; border: 0 solid rgb(229 231 235); }
+body { margin: 0; font-family: ui-sans-serif, system-ui, sans-serif; line-height: 1.5; }
+h1, h2, h3, p { margin: 0; font-size: inherit; font-weight: inherit; }
+button, select { font: inherit; color: inherit; background-color: transparent; padding: 0; cursor: pointer; }
+img { display: block; max-width: 100%; height: auto; }
+"""
+
+
+def spacing(value):
+    # Tailwind's spacing scale: 1 unit = 0.25rem
+    if value == "0":
+        return "0px"
+    if value == "auto":
+        return "auto"
+    if value == "full":
+        return "100%"
+    if "/" in value:
+        numerator, denominator = value.split("/")
+        return f"{int(numerator) / int(denominator) * 100:g}%"
+    if re.fullmatch(r"\d+(\.\d+)?", value):
+        return f"{float(value) / 4:g}rem"
+    return None
+
+
+def declarations(utility):
+    # Returns (selector suffix, declarations) for one utility without
+    # variants, or None when it is unknown
+    negative = utility.startswith("-")
+    name = utility.lstrip("-")
+    if name in STATIC and not negative:
+        return "", STATIC[name]
+    match = re.fullmatch(r"([pm])([xytrbl]?)-(.+)", name)
+    if match:
+        prefix, side, value = match.groups()
+        size = spacing(value)
+        if size is None:
+            return None
+        if negative:
+            size = f"-{size}"
+        property_name = "padding" if prefix == "p" else "margin"
+        return "", "; ".join(f"{property_name}{suffix}: {size}" for suffix in SIDES[side])
+    match = re.fullmatch(r"(top|right|bottom|left|inset)-(.+)", name)
+    if match:
+        side, value = match.groups()
+        size = spacing(value)
+        if size is None:
+            return None
+        size = f"-{size}" if negative else size
+        sides = ("top", "right", "bottom", "left") if side == "inset" else (side,)
+        return "", "; ".join(f"{s}: {size}" for s in sides)
+    match = re.fullmatch(r"(w|h)-(.+)", name)
+    if match:
+        size = "100vh" if match.group(2) == "screen" else spacing(match.group(2))
+        return ("", f"{'width' if match.group(1) == 'w' else 'height'}: {size}") if size else None
+    match = re.fullmatch(r"gap-(.+)", name)
+    if match and spacing(match.group(1)):
+        return "", f"gap: {spacing(match.group(1))}"
+    match = re.fullmatch(r"space-(x|y)-(.+)", name)
+    if match and spacing(match.group(2)):
+        margin = "margin-left" if match.group(1) == "x" else "margin-top"
+        return " > :not([hidden]) ~ :not([hidden])", f"{margin}: {spacing(match.group(2))}"
+    match = re.fullmatch(r"grid-cols-(\d+)", name)
+    if match:
+        return "", f"grid-template-columns: repeat({match.group(1)}, minmax(0, 1fr))"
+    match = re.fullmatch(r"text-(.+)", name)
+    if match and match.group(1) in FONT_SIZES:
+        size, line_height = FONT_SIZES[match.group(1)]
+        return "", f"font-size: {size}; line-height: {line_height}"
+    match = re.fullmatch(r"(text|bg|border)-(.+)", name)
+    if match and match.group(2) in COLORS:
+        kind, rgb = match.group(1), COLORS[match.group(2)]
+        if kind == "bg":
+            return "", f"background-color: rgb({rgb} / var(--tw-bg-opacity, 1))"
+        return "", f"{'color' if kind == 'text' else 'border-color'}: rgb({rgb})"
+    match = re.fullmatch(r"bg-opacity-(\d+)", name)
+    if match:
+        return "", f"--tw-bg-opacity: {int(match.group(1)) / 100:g}"
+    match = re.fullmatch(r"font-(\w+)", name)
+    if match and match.group(1) in FONT_WEIGHTS:
+        return "", f"font-weight: {FONT_WEIGHTS[match.group(1)]}"
+    match = re.fullmatch(r"rounded-?(\w*)", name)
+    if match and match.group(1) in RADII:
+        return "", f"border-radius: {RADII[match.group(1)]}"
+    match = re.fullmatch(r"shadow-(\w+)", name)
+    if match and match.group(1) in SHADOWS:
+        return "", f"box-shadow: {SHADOWS[match.group(1)]}"
+    match = re.fullmatch(r"transition-(\w+)", name)
+    if match and match.group(1) in TRANSITIONS:
+        return "", (
+            f"transition-property: {TRANSITIONS[match.group(1)]}; "
+            "transition-timing-function: cubic-bezier(0.4, 0, 0.2, 1); transition-duration: 150ms"
+        )
+    match = re.fullmatch(r"translate-x-(.+)", name)
+    if match and spacing(match.group(1)):
+        return "", f"--tw-translate-x: {'-' if negative else ''}{spacing(match.group(1))}"
+    match = re.fullmatch(r"z-(\d+)", name)
+    if match:
+        return "", f"z-index: {match.group(1)}"
+    return None
+
+
+def collect_class_strings(source):
+    # String literals inside tw(...) calls, in source order
+    found = []
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "tw":
+            for argument in node.args:
+                for child in ast.walk(argument):
+                    if isinstance(child, ast.Constant) and isinstance(child.value, str) and child.value:
+                        found.append((child.lineno, child.col_offset, child.value))
+    return list(dict.fromkeys(value for _, _, value in sorted(found)))
+
+
+def short_name(index):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    name = ""
+    while True:
+        index, digit = divmod(index, 36)
+        name = digits[digit] + name
+        if not index:
+            return f"c{name}"
+
+
+def state_rank(selector):
+    ranks = [rank for rank, state in enumerate(STATES.values(), 1) if state in selector]
+    return max(ranks, default=0)
+
+
+def build(source):
+    # Returns (class names, stylesheet) or raises ValueError listing the
+    # unknown utilities
+    class_names = {}
+    rules = {}
+    unknown = set()
+    for index, class_string in enumerate(collect_class_strings(source)):
+        name = class_names[class_string] = short_name(index)
+        for utility in class_string.split():
+            *variants, base = utility.split(":")
+            screen = next((v for v in variants if v in SCREENS), None)
+            state = "".join(STATES[v] for v in variants if v in STATES)
+            if utility == "container":
+                continue
+            result = declarations(base)
+            if result is None or any(v not in SCREENS and v not in STATES for v in variants):
+                unknown.add(utility)
+                continue
+            suffix, body = result
+            rules.setdefault((screen, name, state + suffix), []).append(body)
+        if "container" in class_string.split():
+            rules.setdefault((None, name, ""), []).append("width: 100%")
+            for screen, width in SCREENS.items():
+                rules.setdefault((screen, name, ""), []).append(f"max-width: {width}")
+    if unknown:
+        raise ValueError(f"Unknown utilities: {', '.join(sorted(unknown))}")
+    lines = [PREFLIGHT]
+    for screen in (None, *SCREENS):
+        # Pseudo-class rules go after the plain ones, in Tailwind's variant
+        # order, so disabled: wins over hover: on the same element
+        block = [
+            f".{name}{selector} {{ {'; '.join(bodies)}; }}"
+            for (rule_screen, name, selector), bodies in sorted(
+                rules.items(), key=lambda rule: state_rank(rule[0][2]))
+            if rule_screen == screen
+        ]
+        if not block:
+            continue
+        if screen is None:
+            lines.extend(block)
+        else:
+            lines.append(f"@media (min-width: {SCREENS[screen]}) {{")
+            lines.extend(f"  {rule}" for rule in block)
+            lines.append("}")
+    return class_names, "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="fail if the generated files are out of date")
+    args = parser.parse_args()
+
+    try:
+        class_names, stylesheet = build(SOURCE.read_text(encoding="utf-8"))
+    except ValueError as error:
+        sys.exit(str(error))
+    outputs = {
+        STATIC_DIR / "class_names.json": json.dumps(class_names, indent=2, ensure_ascii=False) + "\n",
+        STATIC_DIR / "styles.css": stylesheet,
+    }
+    if args.check:
+        stale = [str(path) for path, content in outputs.items()
+                 if not path.exists() or path.read_text(encoding="utf-8") != content]
+        if stale:
+            sys.exit(f"Out of date, run python build_css.py: {', '.join(stale)}")
+        return
+    STATIC_DIR.mkdir(exist_ok=True)
+    for path, content in outputs.items():
+        path.write_text(content, encoding="utf-8")
+    print(f"{len(class_names)} class strings, {len(stylesheet)} bytes of CSS", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+
+def test_generated_css_is_up_to_date():
+    # Fails on unknown utilities and on stale static/ files alike
+    result = subprocess.run([sys.executable, "build_css.py", "--check"], cwd=ROOT, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
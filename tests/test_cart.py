@@ -0,0 +1,57 @@
+import random
+from decimal import Decimal, ROUND_HALF_UP
+
+import pytest
+
+import app
+
+
+def recompute(cart):
+    # Total and item count from scratch, at each product's current price
+    total = sum(
+        (Decimal(str(item.product.price)).quantize(Decimal("0.01"), ROUND_HALF_UP) * item.quantity
+         for item in cart.items.values()),
+        Decimal(0),
+    )
+    return total, sum(item.quantity for item in cart.items.values())
+
+
+def random_products(rnd, count=8):
+    return [
+        app.Product(product_id, f"Produto {product_id}", "", rnd.choice([0.1, 0.2, 0.3, 19.99, 1e-3, 2.675]),
+                    "", "livros", 100, 4.0)
+        for product_id in range(1, count + 1)
+    ]
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_running_totals_match_a_full_recompute(seed):
+    rnd = random.Random(seed)
+    products = random_products(rnd)
+    cart = app.ShoppingCart()
+    for _ in range(300):
+        product = rnd.choice(products)
+        operation = rnd.choice(["add", "add", "remove", "update", "reprice", "clear"])
+        if operation == "add":
+            cart.add_item(product, rnd.randint(1, 5))
+        elif operation == "remove":
+            cart.remove_item(product.id)
+        elif operation == "update":
+            cart.update_quantity(product.id, rnd.randint(-2, 10))
+        elif operation == "reprice":
+            product.price = round(rnd.uniform(0, 1000), rnd.choice([0, 1, 2, 3]))
+            cart.reprice(product.id)
+        elif rnd.random() < 0.1:
+            cart.clear()
+        total, count = recompute(cart)
+        assert cart.get_total() == total
+        assert cart.get_items_count() == count
+
+
+def test_totals_are_exact_cents():
+    cart = app.ShoppingCart()
+    product = app.Product(1, "A", "", 0.1, "", "livros", 10, 4.0)
+    for _ in range(3):
+        cart.add_item(product)
+    # 0.1 + 0.1 + 0.1 is 0.30000000000000004 in floats
+    assert cart.get_total() == Decimal("0.30")
@@ -0,0 +1,155 @@
+import random
+import sys
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def make_catalog(stock, backend=None):
+    catalog = app.ProductCatalog()
+    if backend is not None:
+        catalog.changes = app.CatalogChangeFeed(backend=backend)
+    catalog.load_products([
+        app.Product(product_id, f"Produto {product_id}", "", 10.0, "", "livros", stock, 4.0)
+        for product_id in range(1, 5)
+    ])
+    return catalog
+
+
+def run_buyers(inventories, buyers=50, checkouts=100, writers=None):
+    # Every buyer reserves and checks out carts of the hot SKUs 1 and 2;
+    # returns the units of each product that were sold
+    sold = {}
+    sold_lock = threading.Lock()
+
+    def buyer(number):
+        inventory = inventories[number % len(inventories)]
+        rnd = random.Random(number)
+        for attempt in range(checkouts):
+            cart_id = f"{number}-{attempt}"
+            items = {1: rnd.randint(1, 3)}
+            if rnd.random() < 0.5:
+                items[2] = 1
+            try:
+                for product_id, quantity in items.items():
+                    if not inventory.reserve(cart_id, product_id, quantity):
+                        raise app.OutOfStockError(product_id)
+                inventory.checkout(cart_id, items)
+            except app.OutOfStockError:
+                inventory.release_all(cart_id)
+                continue
+            with sold_lock:
+                for product_id, quantity in items.items():
+                    sold[product_id] = sold.get(product_id, 0) + quantity
+
+    # Switch threads as often as possible, to widen the race windows
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        done = threading.Event()
+        buyer_threads = [threading.Thread(target=buyer, args=(number,)) for number in range(buyers)]
+        writer_threads = [threading.Thread(target=writer, args=(done,)) for writer in writers or []]
+        for thread in buyer_threads + writer_threads:
+            thread.start()
+        for thread in buyer_threads:
+            thread.join()
+        done.set()
+        for thread in writer_threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    return sold
+
+
+def price_writers(catalog):
+    # Catalog writes, until the buyers are done, that must not undo the
+    # checkouts' decrements
+    def single(done):
+        rnd = random.Random(1)
+        while not done.is_set():
+            catalog.update_product(rnd.choice([1, 2]), price=round(rnd.uniform(5, 50), 2))
+
+    def bulk(done):
+        while not done.is_set():
+            catalog.bulk_update(app.FacetSelection(category="livros"), price=("multiply", 1.01))
+            time.sleep(0.001)
+
+    return [single, bulk]
+
+
+def test_hot_skus_are_never_oversold():
+    catalog = make_catalog(stock=2000)
+    inventory = app.InventoryService(catalog)
+    sold = run_buyers([inventory], writers=price_writers(catalog))
+    assert sold[1] == 2000
+    for product_id in (1, 2):
+        assert catalog.get(product_id).stock == 2000 - sold[product_id] >= 0
+        assert inventory.available(product_id) == catalog.get(product_id).stock
+
+
+def test_failed_checkout_commits_nothing():
+    catalog = make_catalog(stock=5)
+    inventory = app.InventoryService(catalog)
+    assert inventory.reserve("a", 1, 2)
+    with pytest.raises(app.OutOfStockError):
+        inventory.checkout("a", {1: 2, 2: 6})
+    assert catalog.get(1).stock == 5
+    assert catalog.get(2).stock == 5
+    assert inventory.reserved_by("a", 1) == 2
+
+
+def test_checkout_of_a_product_gone_from_the_catalog():
+    catalog = make_catalog(stock=5)
+    inventory = app.InventoryService(catalog)
+    assert inventory.reserve("a", 1, 2)
+    catalog.load_products([catalog.get(2)])
+    with pytest.raises(app.ProductUnavailableError):
+        inventory.checkout("a", {1: 2, 2: 1})
+    assert catalog.get(2).stock == 5
+
+
+def test_catalogs_sharing_a_database_are_never_oversold(tmp_path):
+    path = str(tmp_path / "loja.db")
+    backends = [app.SQLiteCatalogUpdates(path, interval=0.01) for _ in range(2)]
+    catalogs = [make_catalog(stock=1000, backend=backend) for backend in backends]
+    syncs = [backend.start(catalog) for backend, catalog in zip(backends, catalogs)]
+    try:
+        writers = [writer for catalog in catalogs for writer in price_writers(catalog)]
+        sold = run_buyers([app.InventoryService(catalog) for catalog in catalogs], writers=writers)
+    finally:
+        for backend, sync in zip(backends, syncs):
+            backend.stop()
+            sync.join()
+    # Two exchanges: every process writes its last sales, then reads the others'
+    for _ in range(2):
+        for backend, catalog in zip(backends, catalogs):
+            backend.sync(catalog)
+    assert sold[1] == 1000
+    for catalog in catalogs:
+        for product_id in (1, 2):
+            assert catalog.get(product_id).stock == 1000 - sold[product_id] >= 0
+
+
+def test_catalogs_sharing_a_database_converge(tmp_path):
+    # Both processes write the same products before either has synced:
+    # each ends with the writes applied in the order they were logged
+    path = str(tmp_path / "loja.db")
+    backends = [app.SQLiteCatalogUpdates(path) for _ in range(2)]
+    first, second = catalogs = [make_catalog(stock=10, backend=backend) for backend in backends]
+    first.update_product(1, price=100.0)
+    second.update_product(1, price=200.0)
+    first.bulk_update(app.FacetSelection(category="livros"), price=("multiply", 0.5))
+    second.update_product(2, stock=50)
+    first.adjust_stock({2: -3})
+    second.update_product(3, rating=1.0)
+    first.update_product(3, rating=5.0)
+    for backend, catalog in zip(backends, catalogs):
+        backend.sync(catalog)
+    for catalog in catalogs:
+        assert catalog.get(1).price == 100.0
+        assert catalog.get(2).price == 5.0
+        assert catalog.get(2).stock == 47
+        assert catalog.get(3).rating == 5.0
@@ -0,0 +1,37 @@
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return app.InMemorySessionStore(ttl=60)
+    return app.SQLiteSessionStore(str(tmp_path / "sessions.db"), ttl=60)
+
+
+def test_a_saved_login_is_restored(store, monkeypatch):
+    monkeypatch.setattr(app, "session_store", store)
+    logged_out = app.UserSession()
+    app.save_session("visitante", logged_out)
+    app.save_session("cliente", app.create_user_session("cliente"))
+
+    assert not app.create_user_session("visitante").is_logged_in
+    assert app.create_user_session("cliente").current_user.id == app.get_sample_user().id
+    assert app.create_user_session("nova").is_logged_in
+
+
+def test_expired_sessions_are_deleted(store, monkeypatch):
+    store.save("antiga", {"user_id": None})
+    store.save("expirada", {"user_id": None})
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    store.save("recente", {"user_id": None})
+
+    assert store.load("antiga") is None
+    store.expire()
+    monkeypatch.setattr(time, "time", lambda: now)
+    assert store.load("expirada") is None
+    assert store.load("recente") == {"user_id": None}
@@ -0,0 +1,111 @@
+import json
+import time
+
+from reactpy.backend.starlette import Options, configure
+from starlette.applications import Starlette
+from starlette.testclient import TestClient
+
+import app
+
+STREAM = "/_reactpy/stream"
+OVERLAY_OPEN = app.tw("fixed inset-0 bg-black bg-opacity-50 z-10", "block")
+CART_BUTTON = app.tw("relative cursor-pointer")
+
+
+def find(node, predicate):
+    if isinstance(node, dict):
+        if predicate(node):
+            yield node
+        for child in node.get("children", []):
+            yield from find(child, predicate)
+
+
+def texts(node):
+    if isinstance(node, str):
+        yield node
+    elif isinstance(node, dict):
+        for child in node.get("children", []):
+            yield from texts(child)
+
+
+class Client:
+    # Headless client: mirrors the layout from the messages it receives and
+    # counts them
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.model = {}
+        self.messages = 0
+        self.bytes = 0
+
+    def receive(self):
+        text = self.websocket.receive_text()
+        self.messages += 1
+        self.bytes += len(text.encode())
+        message = json.loads(text)
+        self.model = app.replace_at_path(self.model, message["path"], message["model"])
+
+    def receive_until(self, predicate):
+        while not predicate(self.model):
+            self.receive()
+
+    def target(self, event, predicate, index=0):
+        nodes = [node for node in find(self.model, predicate) if event in node.get("eventHandlers", {})]
+        return nodes[index]["eventHandlers"][event]["target"]
+
+    def send(self, target, data):
+        self.websocket.send_text(json.dumps({"type": "layout-event", "target": target, "data": [data]}))
+
+    def by_text(self, text):
+        return lambda node: text in "".join(texts(node))
+
+    def by_class(self, name):
+        return lambda node: node.get("attributes", {}).get("class") == name
+
+    def cart_open(self, model):
+        return any(find(model, self.by_class(OVERLAY_OPEN)))
+
+
+def run_scenario(server):
+    # A burst of typing in the search box, then a burst of "+" clicks in the
+    # cart; each burst ends with a cart toggle the client waits for, so every
+    # update of the burst has been received
+    with TestClient(server) as client, client.websocket_connect(STREAM) as websocket:
+        session = Client(websocket)
+        session.receive()
+        search = session.target("on_change", lambda node: node.get("attributes", {}).get("placeholder") == "Buscar produtos...")
+        for length in range(1, len("smartphone") + 1):
+            session.send(search, {"target": {"value": "smartphone"[:length]}})
+            time.sleep(0.005)
+        # Handlers of the old grid are gone once the results render
+        session.receive_until(lambda model: "Mostrando 1 de 1 produtos" in "".join(texts(model)))
+        # The last product on the page is the search result
+        session.send(session.target("on_click", session.by_text("Adicionar ao Carrinho"), index=-1), {})
+        session.send(session.target("on_click", session.by_class(CART_BUTTON)), {})
+        session.receive_until(session.cart_open)
+        plus = session.target("on_click", lambda node: node.get("children") == ["+"], index=-1)
+        for _ in range(10):
+            session.send(plus, {})
+            time.sleep(0.005)
+        time.sleep(0.2)
+        session.send(session.target("on_click", session.by_class(OVERLAY_OPEN)), {})
+        session.receive_until(lambda model: not session.cart_open(model))
+        return session
+
+
+def baseline_server():
+    server = Starlette()
+    configure(server, app.App, Options())
+    return server
+
+
+def test_coalesced_server_sends_fewer_and_smaller_messages(monkeypatch):
+    # Same featured products and untouched stock for both runs
+    monkeypatch.setattr(app.product_catalog.featured, "clock", lambda: 0.0)
+    monkeypatch.setattr(app, "inventory", app.InventoryService(app.product_catalog))
+    baseline = run_scenario(baseline_server())
+    monkeypatch.setattr(app, "inventory", app.InventoryService(app.product_catalog))
+    coalesced = run_scenario(app.create_server_app())
+    assert "".join(texts(coalesced.model)) == "".join(texts(baseline.model))
+    assert "11" in "".join(texts(coalesced.model))
+    assert coalesced.messages < baseline.messages
+    assert coalesced.bytes < baseline.bytes